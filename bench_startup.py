@@ -0,0 +1,79 @@
+"""
+Mide el arranque en frío de la API: lanza uvicorn varias veces y registra cuánto tarda
+en responder /health/live (proceso vivo) y /health/ready (herramientas MCP cargadas).
+
+Uso:
+    python bench_startup.py [--runs 5] [--port 8011] [--timeout 60]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+def esperar(url: str, deadline: float):
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as respuesta:
+                return json.loads(respuesta.read() or b"{}")
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            time.sleep(0.02)
+    return None
+
+
+def medir_arranque(port: int, timeout: float) -> dict:
+    base = f"http://127.0.0.1:{port}"
+    inicio = time.perf_counter()
+    proceso = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = inicio + timeout
+        live = esperar(f"{base}/health/live", deadline)
+        live_ms = (time.perf_counter() - inicio) * 1000 if live is not None else None
+        ready = esperar(f"{base}/health/ready", deadline)
+        ready_ms = (time.perf_counter() - inicio) * 1000 if ready is not None else None
+        return {
+            "live_ms": live_ms,
+            "ready_ms": ready_ms,
+            "startup": ready.get("startup") if ready else None,
+        }
+    finally:
+        proceso.terminate()
+        proceso.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    resultados = []
+    for i in range(args.runs):
+        resultado = medir_arranque(args.port, args.timeout)
+        resultados.append(resultado)
+        print(f"run {i + 1}: live={resultado['live_ms']}ms ready={resultado['ready_ms']}ms")
+        if resultado["startup"]:
+            print(f"  fases: {resultado['startup']['phases_ms']}")
+
+    for campo in ("live_ms", "ready_ms"):
+        valores = [r[campo] for r in resultados if r[campo] is not None]
+        if valores:
+            print(
+                f"{campo}: mediana={statistics.median(valores):.0f} "
+                f"min={min(valores):.0f} max={max(valores):.0f} (n={len(valores)})"
+            )
+        else:
+            print(f"{campo}: sin datos (timeout)")
+
+
+if __name__ == "__main__":
+    main()
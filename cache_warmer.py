@@ -0,0 +1,176 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from places_cache import PlacesCache, clave_clapzy, clave_google
+from rate_limiter import PRIORIDAD_BACKGROUND, RateLimited
+from events import EVENTO_CACHE_REFRESCADA, publicar_evento
+
+logger = logging.getLogger(__name__)
+
+# Cada cuánto (segundos) se refrescan las entradas precalentadas
+CACHE_WARM_INTERVAL = int(os.getenv("CACHE_WARM_INTERVAL", "21600"))
+# Ventana valle en horas locales "inicio-fin" (fin exclusivo), admite cruzar medianoche: "23-6"
+CACHE_WARM_OFFPEAK_HOURS = os.getenv("CACHE_WARM_OFFPEAK_HOURS", "2-7")
+# Número de queries de Google más frecuentes a precalentar
+CACHE_WARM_TOP_QUERIES = int(os.getenv("CACHE_WARM_TOP_QUERIES", "20"))
+# Token invitado con el que se consultan los establecimientos de Clapzy al precalentar
+CLAPZY_WARM_TOKEN = os.getenv("CLAPZY_WARM_TOKEN")
+# Pausa entre llamadas para no ráfagas contra las APIs durante el calentamiento
+CACHE_WARM_PAUSE = float(os.getenv("CACHE_WARM_PAUSE", "0.5"))
+
+WARM_LOCK_KEY = "cache:warm:lock"
+WARM_LAST_KEY = "cache:warm:last"
+
+
+def _parsear_ventana(ventana: str) -> Tuple[int, int]:
+    inicio, fin = ventana.split("-")
+    return int(inicio) % 24, int(fin) % 24
+
+
+def en_horario_valle(ahora: datetime = None, ventana: str = CACHE_WARM_OFFPEAK_HOURS) -> bool:
+    hora = (ahora or datetime.now()).hour
+    inicio, fin = _parsear_ventana(ventana)
+    if inicio <= fin:
+        return inicio <= hora < fin
+    return hora >= inicio or hora < fin
+
+
+class CacheWarmer:
+    """
+    Precalienta en segundo plano la caché de búsquedas más demandadas:
+    - Todas las combinaciones (ciudad Clapzy × tipo de establecimiento).
+    - Las queries de Google Places más frecuentes.
+
+    Las entradas que faltan se rellenan en cuanto arranca el proceso; los refrescos
+    periódicos solo se hacen dentro de la ventana valle. Con varias réplicas, un lock en
+    Redis garantiza que solo una de ellas calienta en cada ciclo.
+    """
+
+    def __init__(
+        self,
+        cache: PlacesCache,
+        ciudades: List[str],
+        tipos: List[str],
+        consultar_clapzy: Callable,
+        consultar_google: Callable,
+        clapzy_limit: int = 10,
+    ):
+        self.cache = cache
+        self.ciudades = ciudades
+        self.tipos = tipos
+        self.consultar_clapzy = consultar_clapzy
+        self.consultar_google = consultar_google
+        self.clapzy_limit = clapzy_limit
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.cache.redis is None:
+            logger.warning("⚠️ Redis no disponible, no se precalienta la caché")
+            return
+        self._thread = threading.Thread(target=self._run, name="cache-warmer", daemon=True)
+        self._thread.start()
+        logger.info(f"🔥 Precalentador de caché iniciado (cada {CACHE_WARM_INTERVAL}s, valle {CACHE_WARM_OFFPEAK_HOURS})")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        # Primer ciclo: solo lo que falta, sin esperar a la ventana valle
+        self._ejecutar_ciclo(solo_faltantes=True)
+        while not self._stop.wait(60):
+            if not en_horario_valle():
+                continue
+            try:
+                last = self.cache.redis.get(WARM_LAST_KEY)
+            except Exception as e:
+                logger.error(f"❌ Error leyendo último precalentamiento: {e}")
+                continue
+            if last and time.time() - float(last) < CACHE_WARM_INTERVAL:
+                continue
+            self._ejecutar_ciclo(solo_faltantes=False)
+
+    def _ejecutar_ciclo(self, solo_faltantes: bool):
+        redis = self.cache.redis
+        try:
+            if not redis.set(WARM_LOCK_KEY, "1", nx=True, ex=CACHE_WARM_INTERVAL):
+                logger.info("🔒 Otra réplica está precalentando la caché")
+                return
+        except Exception as e:
+            logger.error(f"❌ Error adquiriendo lock de precalentamiento: {e}")
+            return
+
+        inicio = time.perf_counter()
+        calentadas = 0
+        try:
+            calentadas += self._calentar_clapzy(solo_faltantes)
+            calentadas += self._calentar_google(solo_faltantes)
+            if not solo_faltantes:
+                redis.set(WARM_LAST_KEY, str(time.time()))
+        except RateLimited as e:
+            # El cupo se reserva para usuarios: se reintenta en el siguiente ciclo
+            logger.warning(f"🚦 Precalentamiento interrumpido por límite de cupo: {e}")
+        except Exception as e:
+            logger.error(f"❌ Error precalentando caché: {e}")
+        finally:
+            redis.delete(WARM_LOCK_KEY)
+        logger.info(f"🔥 Precalentamiento terminado: {calentadas} entradas en {time.perf_counter() - inicio:.1f}s")
+        if calentadas:
+            # Avisar a los clientes conectados por WebSocket de que hay datos frescos
+            publicar_evento(redis, EVENTO_CACHE_REFRESCADA, {"entries": calentadas})
+
+    def _necesita_refresco(self, key: str, solo_faltantes: bool) -> bool:
+        age = self.cache.age(key)
+        if age is None:
+            return True
+        if solo_faltantes:
+            return False
+        return age >= CACHE_WARM_INTERVAL
+
+    def _calentar_clapzy(self, solo_faltantes: bool) -> int:
+        if not CLAPZY_WARM_TOKEN:
+            logger.warning("⚠️ CLAPZY_WARM_TOKEN no configurado, no se precalienta Clapzy")
+            return 0
+
+        calentadas = 0
+        for ciudad in self.ciudades:
+            for tipo in self.tipos:
+                if self._stop.is_set():
+                    return calentadas
+                # Se consulta en modo invitado, así que solo se calienta la clave de invitados
+                key = clave_clapzy(ciudad, tipo, 1, self.clapzy_limit)
+                if not self._necesita_refresco(key, solo_faltantes):
+                    continue
+                # Modo invitado: token y session_id coinciden
+                resultado = self.consultar_clapzy(
+                    ciudad, tipo, CLAPZY_WARM_TOKEN, CLAPZY_WARM_TOKEN, 1, self.clapzy_limit,
+                    prioridad=PRIORIDAD_BACKGROUND,
+                )
+                if isinstance(resultado, str):
+                    logger.error(f"❌ No se pudo precalentar Clapzy {ciudad}/{tipo}: {resultado}")
+                else:
+                    self.cache.set(key, resultado)
+                    calentadas += 1
+                time.sleep(CACHE_WARM_PAUSE)
+        return calentadas
+
+    def _calentar_google(self, solo_faltantes: bool) -> int:
+        calentadas = 0
+        for query in self.cache.queries_google_frecuentes(CACHE_WARM_TOP_QUERIES):
+            if self._stop.is_set():
+                return calentadas
+            key = clave_google(query)
+            if not self._necesita_refresco(key, solo_faltantes):
+                continue
+            resultado = self.consultar_google(query, prioridad=PRIORIDAD_BACKGROUND)
+            if isinstance(resultado, str):
+                logger.error(f"❌ No se pudo precalentar Google '{query}': {resultado}")
+            else:
+                self.cache.set(key, resultado)
+                calentadas += 1
+            time.sleep(CACHE_WARM_PAUSE)
+        return calentadas
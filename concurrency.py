@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from redis.exceptions import LockError
+
+logger = logging.getLogger(__name__)
+
+# Configuración del control de admisión
+CHAT_MAX_CONCURRENT = int(os.getenv("CHAT_MAX_CONCURRENT", "8"))
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "32"))
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "20"))
+CHAT_RETRY_AFTER = int(os.getenv("CHAT_RETRY_AFTER", "5"))
+CHAT_MAX_SESSION_QUEUE = int(os.getenv("CHAT_MAX_SESSION_QUEUE", "3"))
+# TTL (segundos) del lock distribuido de cada sesión; se renueva mientras el turno sigue en curso
+CHAT_SESSION_LOCK_TIMEOUT = float(os.getenv("CHAT_SESSION_LOCK_TIMEOUT", "120"))
+
+
+class AdmissionRejected(Exception):
+    """
+    Se lanza cuando el servidor está saturado y la petición no puede esperar turno.
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class SessionLocks:
+    """
+    Serializa los turnos de una misma sesión en orden de llegada (FIFO).
+
+    asyncio.Lock despierta a los que esperan en el mismo orden en que llegaron,
+    así que basta un lock por session_id. Los locks se eliminan cuando nadie los usa.
+    Si una sesión acumula más de max_pending turnos pendientes se rechaza el nuevo turno.
+    """
+
+    def __init__(self, max_pending: int, retry_after: int):
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.rejected_total = 0
+        self._locks = {}
+        self._waiters = {}
+
+    def depth(self, session_id: str) -> int:
+        return self._waiters.get(session_id, 0)
+
+    def stats(self) -> dict:
+        return {
+            "active_sessions": len(self._locks),
+            "queued_turns": sum(max(n - 1, 0) for n in self._waiters.values()),
+            "max_pending_per_session": self.max_pending,
+            "rejected_total": self.rejected_total,
+        }
+
+    @asynccontextmanager
+    async def hold(self, session_id: str):
+        if self.depth(session_id) >= self.max_pending:
+            self.rejected_total += 1
+            raise AdmissionRejected("Demasiados mensajes pendientes en la sesión", self.retry_after)
+
+        lock = self._locks.setdefault(session_id, asyncio.Lock())
+        self._waiters[session_id] = self._waiters.get(session_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._waiters[session_id] -= 1
+            if self._waiters[session_id] == 0:
+                del self._waiters[session_id]
+                del self._locks[session_id]
+
+
+@asynccontextmanager
+async def distributed_session_lock(redis, session_id: str):
+    """
+    Lock en Redis por sesión para que dos workers o réplicas no procesen a la vez
+    turnos de la misma sesión. Dentro de cada proceso el orden lo da SessionLocks.
+
+    Un turno puede durar más que el TTL (varios pasos de modelo y llamadas a APIs), así que
+    mientras dura se renueva el lock en segundo plano; si se pierde la propiedad se registra.
+    """
+    lock = redis.lock(
+        f"chat_lock:{session_id}",
+        timeout=CHAT_SESSION_LOCK_TIMEOUT,
+        blocking_timeout=CHAT_QUEUE_TIMEOUT,
+    )
+    if not await lock.acquire():
+        raise AdmissionRejected("La sesión está ocupada en otro worker", CHAT_RETRY_AFTER)
+    renewal = asyncio.create_task(_renew_lock(lock, session_id))
+    try:
+        yield
+    finally:
+        renewal.cancel()
+        try:
+            await lock.release()
+        except LockError:
+            logger.error(f"❌ El lock de la sesión {session_id} expiró o cambió de dueño antes de terminar el turno")
+
+
+async def _renew_lock(lock, session_id: str):
+    while True:
+        await asyncio.sleep(CHAT_SESSION_LOCK_TIMEOUT / 3)
+        try:
+            await lock.reacquire()
+        except LockError:
+            logger.error(f"❌ Se perdió el lock de la sesión {session_id} durante el turno")
+            return
+        except Exception as e:
+            logger.error(f"❌ Error renovando el lock de la sesión {session_id}: {e}")
+
+
+class AdmissionController:
+    """
+    Limita las llamadas concurrentes al agente con una cola de espera acotada.
+
+    - Hasta max_concurrent peticiones se ejecutan a la vez.
+    - Hasta max_queue peticiones esperan turno como máximo queue_timeout segundos.
+    - El resto se rechaza con AdmissionRejected (el endpoint responde 429 + Retry-After).
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float, retry_after: int):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.timed_out_total = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.last_wait_time = 0.0
+
+    def _record_wait(self, waited: float):
+        self.last_wait_time = waited
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+
+    @asynccontextmanager
+    async def admit(self):
+        started = time.perf_counter()
+        if not self._semaphore.locked():
+            # Hay hueco libre: se adquiere sin pasar por la cola
+            await self._semaphore.acquire()
+        else:
+            if self.queued >= self.max_queue:
+                self.rejected_total += 1
+                raise AdmissionRejected("Cola de espera llena", self.retry_after)
+
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.timed_out_total += 1
+                raise AdmissionRejected("Tiempo de espera agotado en la cola", self.retry_after)
+            finally:
+                self.queued -= 1
+
+        self._record_wait(time.perf_counter() - started)
+        self.in_flight += 1
+        self.admitted_total += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+            "timed_out_total": self.timed_out_total,
+            "wait_time_last_ms": round(self.last_wait_time * 1000, 2),
+            "wait_time_avg_ms": round(self.wait_time_total / self.admitted_total * 1000, 2) if self.admitted_total else 0.0,
+            "wait_time_max_ms": round(self.wait_time_max * 1000, 2),
+        }
+
+
+session_locks = SessionLocks(CHAT_MAX_SESSION_QUEUE, CHAT_RETRY_AFTER)
+admission = AdmissionController(CHAT_MAX_CONCURRENT, CHAT_MAX_QUEUE, CHAT_QUEUE_TIMEOUT, CHAT_RETRY_AFTER)
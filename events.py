@@ -0,0 +1,24 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Canal de Redis por el que los procesos de fondo avisan a las conexiones WebSocket abiertas
+EVENTS_CHANNEL = os.getenv("EVENTS_CHANNEL", "gaia:events")
+
+EVENTO_CACHE_REFRESCADA = "cache_refreshed"
+EVENTO_INDICE_ACTUALIZADO = "spatial_index_updated"
+
+
+def publicar_evento(redis, tipo: str, datos: dict = None):
+    """
+    Publica un evento para las conexiones WebSocket de todas las réplicas (cliente Redis síncrono).
+    """
+    if redis is None:
+        return
+    try:
+        redis.publish(EVENTS_CHANNEL, json.dumps({"event": tipo, "ts": time.time(), **(datos or {})}))
+    except Exception as e:
+        logger.error(f"❌ Error publicando evento '{tipo}': {e}")
@@ -1,4 +1,6 @@
 import random
+import time
+from contextlib import contextmanager
 
 
 def get_greeting_message():
@@ -14,3 +16,45 @@ def get_greeting_message():
         "No prometo amor eterno, pero sí planes inolvidables. ❤️‍🔥",
     ]
     return random.choice(greetings)
+
+
+class StartupProfile:
+    """
+    Registra cuánto tarda cada fase del arranque (en milisegundos).
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.total_ms = None
+        self.error = None
+
+    def record(self, name, elapsed_ms):
+        self.phases[name] = round(elapsed_ms, 1)
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - started) * 1000)
+
+    async def timed(self, name, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.record(name, (time.perf_counter() - started) * 1000)
+
+    def ready(self, process_started_at):
+        self.total_ms = round((time.perf_counter() - process_started_at) * 1000, 1)
+
+    def fail(self, error):
+        self.error = str(error)
+
+    def report(self):
+        return {
+            "phases_ms": dict(self.phases),
+            "total_ms": self.total_ms,
+            "error": self.error,
+        }
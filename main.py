@@ -1,22 +1,31 @@
+import time
+
+PROCESS_STARTED_AT = time.perf_counter()
+
+import asyncio
 import json
+import logging
 import os
+import signal
+from urllib.parse import quote
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from langchain_mcp_adapters.tools import load_mcp_tools
-from mcp import StdioServerParameters, ClientSession
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from langchain_openai import ChatOpenAI
-from langchain_mcp_adapters.client import MultiServerMCPClient
-from langgraph.checkpoint.memory import MemorySaver
-from langgraph.prebuilt import create_react_agent
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
-from contextlib import asynccontextmanager
+from contextlib import AsyncExitStack, asynccontextmanager
 from redis import Redis
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
+from redis.asyncio import Redis as AsyncRedis
 
-from helpers import get_greeting_message
+from concurrency import AdmissionRejected, admission, distributed_session_lock, session_locks
+from helpers import get_greeting_message, StartupProfile
+from places_cache import snapshot as cache_snapshot
+from rate_limiter import UPSTREAM_GOOGLE, registrar_prioridad_sesion, snapshot as rate_limit_snapshot
+from realtime import WS_AUTH_TIMEOUT, WS_MAX_PENDING_TURNS, ChatConnection, EventHub
+from result_store import FUENTE_CLAPZY, FUENTE_GOOGLE, ResultStore
+
+logger = logging.getLogger(__name__)
 
 # Cargar variables de entorno
 load_dotenv()
@@ -26,21 +35,75 @@ DEVELOPMENT = os.getenv("DEVELOPMENT")
 OPENAI_PROXY = None
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
+GOOGLE_PLACES_API_KEY = os.getenv("GOOGLE_PLACES_API_KEY")
+
+# Conexión a Redis: los clientes síncrono y asíncrono y el checkpointer usan la misma URL
+REDIS_URL = (
+    f"redis://:{quote(REDIS_PASSWORD, safe='')}@{REDIS_HOST}:6379/0" if REDIS_PASSWORD else f"redis://{REDIS_HOST}:6379/0"
+)
+redis = Redis.from_url(REDIS_URL, decode_responses=True)
+redis_async = AsyncRedis.from_url(REDIS_URL, decode_responses=True)
+
+# Conjuntos de resultados que guardan las herramientas para refinar (se borran al resetear)
+result_store = ResultStore(redis)
+
+# Checkpointer de LangGraph compartido entre workers/réplicas (requiere Redis Stack)
+CHECKPOINT_TTL_MINUTES = int(os.getenv("CHECKPOINT_TTL_MINUTES", "1440"))
 
-# Conexión a Redis
-redis = Redis(host=REDIS_HOST, port=6379, db=0, decode_responses=True)
+# Mensajes humano/IA de turnos anteriores que se envían al modelo
+HISTORY_MAX_MESSAGES = 6
 
 ## if DEVELOPMENT == 'True':
     ## OPENAI_PROXY = "http://localhost:5000"
 
-# Configurar el modelo
-model = ChatOpenAI(
-    api_key=OPENAI_API_KEY,
-    model=OPENAI_API_MODEL,
-    temperature=0.6,
-    ##top_p=0.85,
-    openai_proxy=OPENAI_PROXY
-)
+
+def build_model():
+    """
+    Configura los modelos. Importa langchain_openai aquí para no pagar su coste
+    al importar el módulo: se ejecuta en paralelo con el arranque del servidor MCP.
+
+    Si OPENAI_API_MODEL_LIGHT está definido, los turnos ligeros (charla, redacción de
+    resultados ya obtenidos) se enrutan a ese modelo; el resto al modelo principal.
+    """
+    from langchain_openai import ChatOpenAI
+    from model_router import (
+        MODEL_LIGHT_TIMEOUT,
+        MODEL_MAIN_TIMEOUT,
+        OPENAI_API_MODEL_LIGHT,
+        ModelRouter,
+    )
+
+    main_model = ChatOpenAI(
+        api_key=OPENAI_API_KEY,
+        model=OPENAI_API_MODEL,
+        temperature=0.6,
+        ##top_p=0.85,
+        openai_proxy=OPENAI_PROXY,
+        timeout=MODEL_MAIN_TIMEOUT,
+    )
+
+    light_model = None
+    if OPENAI_API_MODEL_LIGHT:
+        light_model = ChatOpenAI(
+            api_key=OPENAI_API_KEY,
+            model=OPENAI_API_MODEL_LIGHT,
+            temperature=0.6,
+            openai_proxy=OPENAI_PROXY,
+            timeout=MODEL_LIGHT_TIMEOUT,
+        )
+
+    return ModelRouter(main_model, light_model)
+
+
+def load_agent_stack():
+    """
+    Importa el stack de LangChain/LangGraph y crea los modelos (se ejecuta en un hilo).
+    """
+    from langchain_mcp_adapters.tools import load_mcp_tools
+    from langgraph.checkpoint.redis.aio import AsyncRedisSaver
+    from langgraph.prebuilt import create_react_agent
+
+    return build_model(), load_mcp_tools, create_react_agent, AsyncRedisSaver
 
 system_prompt = lambda session_id, token: f"""
 Eres GAIA, el buscador inteligente y motivador de Clapzy. Tu estilo es divertido, cool, gracioso, frontal y elegante, sin género definido. 
@@ -119,6 +182,11 @@ Eres GAIA, el buscador inteligente y motivador de Clapzy. Tu estilo es divertido
    - Parámetros: city (texto natural), establishment_type
    - Tipos: "Restaurante", "Bar y cocteles", "Música y fiesta", "Diversión y juegos", "Aventura al aire libre"  
    
+   **🔎 Refinar resultados (refinar_resultados_anteriores)**:
+   - Úsala cuando el usuario ajusta una búsqueda que ya hiciste: "menos costoso", otro presupuesto, mejor rating, solo abiertos ahora, otro tipo dentro de lo ya buscado, "no repitas lugares"
+   - Parámetros: session_id, nivel_precio_max, nivel_precio_min, rating_min, tipo, abierto_ahora, excluir (nombres que ya recomendaste)
+   - Si responde que no quedan lugares, entonces sí haz una búsqueda nueva
+
    **📝 PRESENTACIÓN DE RESULTADOS**:
    - SOLO presenta lugares que encuentres con las herramientas
    - Ejemplo: "Encontré estos lugares que van a enamorarte..."
@@ -173,7 +241,7 @@ Responde siempre en el idioma del usuario y sé esa voz que empuja a vivir bueno
    - barato = price_level 1–2
    - medio = 2–3
    - alto/fancy = 3–4
-   - Si el usuario pide “menos costoso”, baja un nivel y no repitas lugares fuera de rango.
+   - Si el usuario pide “menos costoso”, baja un nivel y no repitas lugares fuera de rango (usa refinar_resultados_anteriores antes de buscar de nuevo).
 
 3) Diversifica (no más de 2 por sub-tipo) y prioriza lugares con mejor score (rating + reviews + precio adecuado + fotos).
 
@@ -181,8 +249,38 @@ Responde siempre en el idioma del usuario y sé esa voz que empuja a vivir bueno
 
 """
 
-# Memoria por sesión
-session_histories = {}
+def trim_history(messages):
+    """
+    Recorta el historial que ve el modelo: los últimos mensajes humano/IA de turnos
+    anteriores (sin llamadas a herramientas) más todo lo generado en el turno actual.
+    """
+    last_human_index = -1
+    for i in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[i], HumanMessage):
+            last_human_index = i
+            break
+    if last_human_index == -1:
+        return list(messages)
+
+    previous = [
+        msg for msg in messages[:last_human_index + 1]
+        if isinstance(msg, HumanMessage) or (isinstance(msg, AIMessage) and not msg.tool_calls)
+    ]
+    return previous[-HISTORY_MAX_MESSAGES:] + list(messages[last_human_index + 1:])
+
+
+def agent_prompt(state, config):
+    """
+    System prompt + historial recortado. session_id y token llegan en la config de cada turno,
+    así el estado guardado en Redis solo contiene la conversación.
+    """
+    configurable = config["configurable"]
+    system_content = system_prompt(configurable["session_id"], configurable["token"])
+    return [SystemMessage(content=system_content)] + trim_history(state["messages"])
+
+
+def session_config(session_id: str, token: str) -> dict:
+    return {"configurable": {"thread_id": session_id, "session_id": session_id, "token": token}}
 
 
 # Modelo del cuerpo de la solicitud
@@ -192,29 +290,94 @@ class MessageRequest(BaseModel):
     token: str
 
 
-# Context manager para manejar eventos de inicio y cierre de la aplicación
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    MCP_SERVER_URL = os.getenv("MCP_SERVER_URL", "http://localhost:8000")
+async def run_agent(app: FastAPI, stop: asyncio.Event):
+    """
+    Arranca el servidor MCP y crea el agente mientras la API ya acepta peticiones.
 
-    server_params = StdioServerParameters(
-        command="python",
-        # Make sure to update to the full absolute path to your math_server.py file
-        args=["mcp_server.py"],
-    )
+    El proceso hijo se lanza lo primero y, mientras arranca, otro hilo importa el stack
+    de LangChain/LangGraph. La sesión MCP queda abierta hasta que se pide el cierre.
+    """
+    profile = app.state.startup_profile
+    try:
+        with profile.phase("import_mcp"):
+            from mcp import ClientSession, StdioServerParameters
+            from mcp.client.stdio import stdio_client
+
+        server_params = StdioServerParameters(
+            command="python",
+            # Make sure to update to the full absolute path to your math_server.py file
+            args=["mcp_server.py"],
+        )
+
+        async with AsyncExitStack() as stack:
+            with profile.phase("spawn_mcp"):
+                read, write = await stack.enter_async_context(stdio_client(server_params))
+
+            # Mientras el hijo arranca, importar LangChain/LangGraph en otro hilo
+            agent_stack = asyncio.create_task(profile.timed("import_agent_stack", asyncio.to_thread(load_agent_stack)))
+
+            session = await stack.enter_async_context(ClientSession(read, write))
 
-    async with stdio_client(server_params) as (read, write):
-        async with ClientSession(read, write) as session:
             # Initialize the connection
-            await session.initialize()
+            with profile.phase("mcp_initialize"):
+                await session.initialize()
+
+            model_router, load_mcp_tools, create_react_agent, AsyncRedisSaver = await agent_stack
 
             # Get tools
-            tools = await load_mcp_tools(session)
+            with profile.phase("load_mcp_tools"):
+                tools = await load_mcp_tools(session)
+
+            # Estado de las conversaciones en Redis, compartido por todos los workers
+            with profile.phase("checkpointer_setup"):
+                checkpointer = await stack.enter_async_context(
+                    AsyncRedisSaver.from_conn_string(
+                        REDIS_URL, ttl={"default_ttl": CHECKPOINT_TTL_MINUTES, "refresh_on_read": True}
+                    )
+                )
+                await checkpointer.asetup()
 
             # Create and run the agent
-            app.state.agent = create_react_agent(model, tools=tools)
+            with profile.phase("create_agent"):
+                app.state.model_router = model_router.bind_tools(tools)
+                app.state.agent = create_react_agent(
+                    model_router.select, tools=tools, prompt=agent_prompt, checkpointer=checkpointer
+                )
+
+            profile.ready(PROCESS_STARTED_AT)
+            logger.info(f"🚀 Agente listo: {profile.report()}")
+
+            try:
+                await stop.wait()
+            finally:
+                app.state.agent = None
+    except Exception as e:
+        profile.fail(e)
+        logger.exception(f"❌ Error arrancando el agente: {e}")
+        # Sin agente el proceso no puede atender: se detiene para que el orquestador lo reinicie
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+# Context manager para manejar eventos de inicio y cierre de la aplicación
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.agent = None
+    app.state.model_router = None
+    app.state.startup_profile = StartupProfile()
+    app.state.startup_profile.record("import_main", (time.perf_counter() - PROCESS_STARTED_AT) * 1000)
+
+    # Eventos de los procesos de fondo (caché, índice espacial) para las conexiones WebSocket
+    app.state.event_hub = EventHub(redis_async)
+    app.state.event_hub.start()
 
-            yield
+    stop = asyncio.Event()
+    task = asyncio.create_task(run_agent(app, stop))
+
+    yield
+
+    stop.set()
+    await task
+    await app.state.event_hub.stop()
 
 
 
@@ -232,112 +395,424 @@ app.add_middleware(
 
 @app.post("/chat")
 async def chat(req: MessageRequest, request: Request):
+    """
+    Atiende un turno de conversación.
+
+    Los turnos de una misma sesión se ejecutan en orden (FIFO) y el número de llamadas
+    simultáneas al agente está acotado; si el servidor está saturado responde 429 con Retry-After.
+    """
+    try:
+        async with session_locks.hold(req.session_id):
+            async with distributed_session_lock(redis_async, req.session_id):
+                # El saludo no depende del agente: se responde aunque aún no esté listo
+                agent = request.app.state.agent
+                config = session_config(req.session_id, req.token)
+                if not await session_started(agent, req.session_id, config):
+                    return await start_session(agent, req, config)
+
+                if agent is None:
+                    return JSONResponse(
+                        status_code=503,
+                        content={"error": "El agente aún no está listo", "retry_after": admission.retry_after},
+                        headers={"Retry-After": str(admission.retry_after)},
+                    )
+
+                async with admission.admit():
+                    return await handle_chat(agent, req, config)
+    except AdmissionRejected as e:
+        return JSONResponse(
+            status_code=429,
+            content={"error": e.reason, "retry_after": e.retry_after},
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+def collect_tool_results(session_id: str, all_messages) -> dict:
+    """
+    Detecta qué herramientas se ejecutaron en el último turno y recoge de Redis
+    los lugares que guardaron (las claves se borran al leerlas).
+    """
+    # Inicializar variables
+    result_google_places = None
+    result_clapzy = None
+    tool_google_places_executed = False
+    tool_clapzy_executed = False
+    raw_query = None
+
+    # Encontrar el índice del último mensaje humano para identificar mensajes nuevos
+    last_human_index = -1
+    
+    for i in range(len(all_messages) - 1, -1, -1):
+        if hasattr(all_messages[i], 'type') and all_messages[i].type == "human":
+            last_human_index = i
+            break
+    
+    # Los mensajes NUEVOS son los que vienen después del último mensaje humano
+    if last_human_index != -1:
+        new_messages = all_messages[last_human_index + 1:]
+        
+        # Buscar herramientas ejecutadas en los mensajes NUEVOS solamente
+        for message in new_messages:
+            if hasattr(message, 'type') and message.type == "tool" and hasattr(message, 'name'):
+                if message.name == "recomendar_lugares_google_places":
+                    tool_google_places_executed = True
+                elif message.name in ("buscar_establecimientos_clapzy_por_ciudad", "buscar_establecimientos_clapzy_por_coordenadas"):
+                    tool_clapzy_executed = True
+                elif message.name == "refinar_resultados_anteriores":
+                    # La herramienta indica en qué fuentes guardó los lugares refinados
+                    fuentes = redis.smembers(f"""{session_id}_refined""")
+                    redis.delete(f"""{session_id}_refined""")
+                    tool_google_places_executed = tool_google_places_executed or FUENTE_GOOGLE in fuentes
+                    tool_clapzy_executed = tool_clapzy_executed or FUENTE_CLAPZY in fuentes
+
+    # Obtener resultados de Google Places si se ejecutó en esta respuesta
+    if tool_google_places_executed:
+        raw_places = redis.get(f"""{session_id}""")
+        raw_query = redis.get(f"""{session_id}_query""")
+        if raw_places:
+            result_google_places = json.loads(raw_places)
+            redis.delete(f"""{session_id}""")
+        if raw_query:
+            redis.delete(f"""{session_id}_query""")
+
+    # Obtener resultados de Clapzy si se ejecutó en esta respuesta
+    if tool_clapzy_executed:
+        raw_places_clapzy = redis.get(f"""{session_id}_clapzy""")
+        if raw_places_clapzy:
+            result_clapzy = json.loads(raw_places_clapzy)
+            redis.delete(f"""{session_id}_clapzy""")
+
+    return {
+        "result_google_places": result_google_places,
+        "result_clapzy": result_clapzy,
+        "tool_google_places_executed": tool_google_places_executed,
+        "tool_clapzy_executed": tool_clapzy_executed,
+        "query": raw_query,
+    }
+
+
+def session_started_key(session_id: str) -> str:
+    return f"session_started:{session_id}"
+
+
+def pending_greeting_key(session_id: str) -> str:
+    return f"pending_greeting:{session_id}"
+
+
+async def session_started(agent, session_id: str, config: dict) -> bool:
+    """
+    Indica si la sesión ya tiene conversación. Se resuelve con una clave en Redis para no
+    depender del agente; si la clave no existe y el agente está listo se consulta el
+    checkpointer (hilos anteriores a la clave o cuya clave ya expiró).
+    """
+    if await redis_async.exists(session_started_key(session_id)):
+        return True
+    if agent is None:
+        return False
+    state = await agent.aget_state(config)
+    if not state.values.get("messages"):
+        return False
+    await redis_async.set(session_started_key(session_id), "1", ex=CHECKPOINT_TTL_MINUTES * 60)
+    return True
+
+
+async def seed_pending_greeting(agent, session_id: str, config: dict):
+    """
+    Guarda en el hilo del agente el saludo que se respondió antes de que el agente estuviera listo.
+    """
+    greeting_text = await redis_async.getdel(pending_greeting_key(session_id))
+    if greeting_text:
+        await agent.aupdate_state(config, {"messages": [AIMessage(content=greeting_text)]}, as_node="agent")
+
+
+async def start_session(agent, req: MessageRequest, config: dict):
+    """
+    Primer contacto de una sesión: guarda un saludo aleatorio en el estado del agente
+    y lo devuelve directamente sin llamar al modelo. Si el agente aún no está listo,
+    el saludo queda pendiente en Redis y se añade al hilo en el primer turno.
+    """
+    greeting_text = get_greeting_message()
+    greeting_message = AIMessage(content=greeting_text)
+    ttl = CHECKPOINT_TTL_MINUTES * 60
+    if agent is not None:
+        await agent.aupdate_state(config, {"messages": [greeting_message]}, as_node="agent")
+    else:
+        await redis_async.set(pending_greeting_key(req.session_id), greeting_text, ex=ttl)
+    await redis_async.set(session_started_key(req.session_id), "1", ex=ttl)
+
+    return {
+        "response": greeting_message,
+        "result_google_places": None,
+        "result_clapzy": None,
+        "tool_google_places": None,
+        "tool_clapzy": None,
+        "messages": [SystemMessage(content=system_prompt(req.session_id, req.token)), greeting_message]
+    }
+
+
+async def handle_chat(agent, req: MessageRequest, config: dict):
     session_id = req.session_id
     user_input = req.message
     token = req.token
 
-    print(session_histories)
+    # Las herramientas priorizan el cupo de APIs externas según el tipo de sesión
+    registrar_prioridad_sesion(redis, session_id, token)
 
-    # Inicializar historial si no existe
-    if session_id not in session_histories:
-        # Usamos siempre el mismo system prompt
-        system_content = system_prompt(session_id, token)
+    try:
+        await seed_pending_greeting(agent, session_id, config)
 
-        # Inicializar historial con mensaje del sistema
-        session_histories[session_id] = [SystemMessage(content=system_content)]
+        # El historial vive en el checkpointer: solo se envía el mensaje nuevo
+        response = await agent.ainvoke(
+            {"messages": [HumanMessage(content=user_input)]},
+            config=config,
+        )
 
-        # Añadir saludo inicial aleatorio
-        greeting_text = get_greeting_message()
-        greeting_message = AIMessage(content=greeting_text)
-        session_histories[session_id].append(greeting_message)
+        ai_msg = response["messages"][-1]
+        results = collect_tool_results(session_id, response["messages"])
 
-        # Devolver directamente el saludo sin llamar al modelo
         return {
-            "response": greeting_message,
-            "result_google_places": None,
-            "result_clapzy": None,
-            "tool_google_places": None,
-            "tool_clapzy": None,
-            "messages": session_histories[session_id]
+            "response": ai_msg,
+            "result_google_places": results["result_google_places"],
+            "result_clapzy": results["result_clapzy"],
+            "tool_google_places_executed": results["tool_google_places_executed"],  # True/False si se ejecutó en esta respuesta
+            "tool_clapzy_executed": results["tool_clapzy_executed"],                # True/False si se ejecutó en esta respuesta
+            "messages": [SystemMessage(content=system_prompt(session_id, token))] + trim_history(response["messages"]),
+            "query": results["query"]
         }
 
-    # Añadir el mensaje del usuario
-    history = session_histories[session_id]
-    history.append(HumanMessage(content=user_input))
 
-    # Limitar historial a últimos 6 mensajes + prompt
-    trimmed = [history[0]] + [msg for msg in history[1:] if isinstance(msg, (HumanMessage, AIMessage))][-6:]
+    except Exception as e:
+        return {"error": str(e)}
 
-    try:
-        response = await request.app.state.agent.ainvoke(
-            {"messages": trimmed},
-            config={"configurable": {"thread_id": session_id}},
-        )
 
-        # Añadir respuesta del agente al historial
-        ai_msg = response["messages"][-1]
-        session_histories[session_id].append(ai_msg)
-
-        # Inicializar variables
-        result_google_places = None
-        result_clapzy = None
-        tool_google_places_executed = False
-        tool_clapzy_executed = False
-        raw_query = None
-
-        # Encontrar el índice del último mensaje humano para identificar mensajes nuevos
-        all_messages = response["messages"]
-        last_human_index = -1
-        
-        for i in range(len(all_messages) - 1, -1, -1):
-            if hasattr(all_messages[i], 'type') and all_messages[i].type == "human":
-                last_human_index = i
-                break
-        
-        # Los mensajes NUEVOS son los que vienen después del último mensaje humano
-        if last_human_index != -1:
-            new_messages = all_messages[last_human_index + 1:]
-            
-            # Buscar herramientas ejecutadas en los mensajes NUEVOS solamente
-            for message in new_messages:
-                if hasattr(message, 'type') and message.type == "tool" and hasattr(message, 'name'):
-                    if message.name == "recomendar_lugares_google_places":
-                        tool_google_places_executed = True
-                    elif message.name == "buscar_establecimientos_clapzy_por_ciudad":
-                        tool_clapzy_executed = True
-
-        # Obtener resultados de Google Places si se ejecutó en esta respuesta
-        if tool_google_places_executed:
-            raw_places = redis.get(f"""{session_id}""")
-            raw_query = redis.get(f"""{session_id}_query""")
-            if raw_places:
-                result_google_places = json.loads(raw_places)
-                redis.delete(f"""{session_id}""")
-            if raw_query:
-                redis.delete(f"""{session_id}_query""")
-
-        # Obtener resultados de Clapzy si se ejecutó en esta respuesta
-        if tool_clapzy_executed:
-            raw_places_clapzy = redis.get(f"""{session_id}_clapzy""")
-            if raw_places_clapzy:
-                result_clapzy = json.loads(raw_places_clapzy)
-                redis.delete(f"""{session_id}_clapzy""")
+@app.websocket("/ws/chat")
+async def chat_ws(websocket: WebSocket):
+    """
+    Chat sobre una conexión persistente: se autentica una sola vez y multiplexa por el mismo
+    socket los tokens del modelo, los eventos de herramientas, los resultados y los avisos
+    del servidor.
+
+    Cliente → servidor:
+        {"type": "auth", "session_id": ..., "token": ...}   (primer mensaje, obligatorio)
+        {"type": "message", "id": ..., "message": ...}
+        {"type": "ping"}
+    Servidor → cliente:
+        ready, token, tool_start, tool_end, result, done, error, event, pong
+        (los eventos de un turno llevan el "id" del mensaje que los originó)
+    """
+    await websocket.accept()
+    connection = await authenticate_ws(websocket)
+    if connection is None:
+        return
 
+    event_hub = websocket.app.state.event_hub
+    event_hub.register(connection)
+    try:
+        await connection.send("ready", session_id=connection.session_id)
+        if not connection.started:
+            await send_greeting(websocket.app.state.agent, connection)
+
+        while True:
+            data = await receive_ws_json(websocket)
+            tipo = data.get("type") if isinstance(data, dict) else None
+            if tipo == "ping":
+                await connection.send("pong")
+            elif tipo == "message" and isinstance(data.get("message"), str):
+                turn_id = data.get("id")
+                if connection.pending_turns >= WS_MAX_PENDING_TURNS:
+                    await connection.send(
+                        "error", id=turn_id, code=429, error="Demasiados mensajes pendientes en la sesión",
+                        retry_after=admission.retry_after,
+                    )
+                    continue
+                # El turno corre en otra tarea para seguir leyendo (ping) mientras el agente trabaja
+                connection.pending_turns += 1
+                task = asyncio.create_task(ws_turn(websocket.app, connection, turn_id, data["message"]))
+                connection.tasks.add(task)
+                task.add_done_callback(connection.tasks.discard)
+            else:
+                await connection.send("error", code=400, error="Mensaje no reconocido")
+    except WebSocketDisconnect:
+        pass
+    finally:
+        event_hub.unregister(connection)
+        # Los turnos que aún esperan su turno no deben gastar modelo ni cupo para un cliente que ya
+        # no está; el que está en curso termina para no dejar el hilo con llamadas a medias
+        for task in connection.tasks:
+            if task is not connection.running_task:
+                task.cancel()
+        if connection.open:
+            await websocket.close()
+
+
+async def authenticate_ws(websocket: WebSocket):
+    """
+    Espera el mensaje de autenticación y prepara el estado de la conexión.
+    Cierra con 1008 si no llega a tiempo o es inválido. Si el agente aún no está listo la
+    conexión se acepta igual (como POST /chat): se saluda y los turnos reciben un error 503.
+    """
+    try:
+        data = await asyncio.wait_for(receive_ws_json(websocket), timeout=WS_AUTH_TIMEOUT)
+    except (asyncio.TimeoutError, WebSocketDisconnect):
+        await close_ws(websocket, 1008)
+        return None
+
+    if not isinstance(data, dict) or data.get("type") != "auth":
+        await close_ws(websocket, 1008)
+        return None
+    session_id, token = data.get("session_id"), data.get("token")
+    if not isinstance(session_id, str) or not session_id or not isinstance(token, str) or not token:
+        await close_ws(websocket, 1008)
+        return None
+
+    agent = websocket.app.state.agent
+    connection = ChatConnection(websocket, session_id, token, session_config(session_id, token))
+    # Se resuelve una sola vez por conexión si el hilo ya tiene conversación
+    connection.started = await session_started(agent, session_id, connection.config)
+    return connection
+
+
+async def receive_ws_json(websocket: WebSocket):
+    """
+    Lee el siguiente mensaje del cliente como JSON. Devuelve None si es un frame binario o
+    texto que no es JSON (se responde como mensaje no reconocido en vez de romper la conexión).
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    text = message.get("text")
+    if text is None:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
 
 
-        return {
-            "response": ai_msg,
-            "result_google_places": result_google_places,
-            "result_clapzy": result_clapzy,
-            "tool_google_places_executed": tool_google_places_executed,  # True/False si se ejecutó en esta respuesta
-            "tool_clapzy_executed": tool_clapzy_executed,                # True/False si se ejecutó en esta respuesta
-            "messages": response["messages"],
-            "query": raw_query
-        }
+async def close_ws(websocket: WebSocket, code: int):
+    try:
+        await websocket.close(code=code)
+    except Exception:
+        pass
 
 
+async def send_greeting(agent, connection: ChatConnection):
+    try:
+        async with session_locks.hold(connection.session_id):
+            async with distributed_session_lock(redis_async, connection.session_id):
+                # Otra conexión o un POST /chat pudo iniciar la sesión mientras tanto
+                if not await session_started(agent, connection.session_id, connection.config):
+                    greeting = await start_session(
+                        agent, MessageRequest(session_id=connection.session_id, message="", token=connection.token), connection.config
+                    )
+                    await connection.send("done", id=None, response=greeting["response"])
+    except AdmissionRejected as e:
+        await connection.send("error", id=None, code=429, error=e.reason, retry_after=e.retry_after)
+        return
+    connection.started = True
+
+
+async def ws_turn(app: FastAPI, connection: ChatConnection, turn_id, user_input: str):
+    """
+    Un turno por WebSocket: mismo orden por sesión y control de admisión que POST /chat,
+    pero la respuesta se envía en streaming a medida que el agente la genera.
+    """
+    try:
+        agent = app.state.agent
+        if agent is None:
+            await connection.send(
+                "error", id=turn_id, code=503, error="El agente aún no está listo", retry_after=admission.retry_after
+            )
+            return
+
+        async with session_locks.hold(connection.session_id):
+            async with distributed_session_lock(redis_async, connection.session_id):
+                async with admission.admit():
+                    connection.running_task = asyncio.current_task()
+                    # Se renueva en cada turno: la conexión puede durar más que el TTL de la prioridad
+                    registrar_prioridad_sesion(redis, connection.session_id, connection.token)
+                    await stream_turn(agent, connection, turn_id, user_input)
+    except AdmissionRejected as e:
+        await connection.send("error", id=turn_id, code=429, error=e.reason, retry_after=e.retry_after)
     except Exception as e:
-        return {"error": str(e)}
+        logger.exception(f"❌ Error en turno WebSocket de {connection.session_id}: {e}")
+        await connection.send("error", id=turn_id, code=500, error=str(e))
+    finally:
+        connection.pending_turns -= 1
+        if connection.running_task is asyncio.current_task():
+            connection.running_task = None
+
+
+async def stream_turn(agent, connection: ChatConnection, turn_id, user_input: str):
+    await seed_pending_greeting(agent, connection.session_id, connection.config)
+    async for mode, chunk in agent.astream(
+        {"messages": [HumanMessage(content=user_input)]},
+        config=connection.config,
+        stream_mode=["messages", "updates"],
+    ):
+        if mode == "messages":
+            message, metadata = chunk
+            if metadata.get("langgraph_node") == "agent" and isinstance(message.content, str) and message.content:
+                await connection.send("token", id=turn_id, content=message.content)
+        elif mode == "updates":
+            for node, update in chunk.items():
+                for message in (update or {}).get("messages", []):
+                    if node == "agent" and getattr(message, "tool_calls", None):
+                        for tool_call in message.tool_calls:
+                            await connection.send("tool_start", id=turn_id, tool=tool_call["name"], call_id=tool_call["id"])
+                    elif node == "tools" and message.type == "tool":
+                        await connection.send(
+                            "tool_end", id=turn_id, tool=message.name, call_id=message.tool_call_id,
+                            status=getattr(message, "status", "success"),
+                        )
+
+    state = await agent.aget_state(connection.config)
+    messages = state.values["messages"]
+    results = collect_tool_results(connection.session_id, messages)
+    if results["tool_google_places_executed"] or results["tool_clapzy_executed"]:
+        await connection.send("result", id=turn_id, **results)
+    await connection.send("done", id=turn_id, response=messages[-1])
+
+
+@app.get("/health/live")
+async def liveness(request: Request):
+    """
+    El proceso está vivo y atiende peticiones (aunque el agente aún no esté listo).
+    Falla si el arranque del agente falló: el proceso ya se está deteniendo.
+    """
+    profile = request.app.state.startup_profile
+    if profile.error is not None:
+        return JSONResponse(status_code=503, content={"status": "failed", "error": profile.error})
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+async def readiness(request: Request):
+    """
+    Solo responde 200 cuando las herramientas MCP están cargadas y el agente creado.
+    """
+    profile = request.app.state.startup_profile.report()
+    if request.app.state.agent is None:
+        return JSONResponse(status_code=503, content={"status": "starting", "startup": profile})
+    return {"status": "ready", "startup": profile}
+
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    """
+    Estado del control de admisión (profundidad de colas y tiempos de espera),
+    latencia/tokens por ruta de modelo, cupo restante de las APIs externas, aciertos de la
+    caché de lugares (por modo y hora) y conexiones WebSocket.
+    """
+    model_router = request.app.state.model_router
+    return {
+        "admission": admission.stats(),
+        "sessions": session_locks.stats(),
+        "models": model_router.stats() if model_router is not None else None,
+        "upstreams": rate_limit_snapshot(redis, {UPSTREAM_GOOGLE: GOOGLE_PLACES_API_KEY}),
+        "cache": cache_snapshot(redis),
+        "websockets": request.app.state.event_hub.stats(),
+    }
 
 
 class ResetRequest(BaseModel):
@@ -345,18 +820,24 @@ class ResetRequest(BaseModel):
 
 
 @app.post("/reset_session")
-async def reset_session(request_data: ResetRequest):
+async def reset_session(request_data: ResetRequest, request: Request):
     """
     Resetea completamente el historial y estado del agente para una sesión específica.
     """
 
     session_id = request_data.session_id
     try:
-        # Limpiar historial en memoria local
-        if session_id in session_histories:
-            del session_histories[session_id]
+        agent = request.app.state.agent
+        if agent is None:
+            raise RuntimeError("El agente aún no está listo")
+
+        # Borrar los checkpoints de la sesión en Redis
+        await agent.checkpointer.adelete_thread(session_id)
+        await redis_async.delete(session_started_key(session_id), pending_greeting_key(session_id))
 
-        print(session_histories)
+        # Borrar los resultados guardados para refinar y los pendientes de entregar
+        result_store.borrar(session_id)
+        redis.delete(session_id, f"{session_id}_query", f"{session_id}_clapzy", f"{session_id}_refined")
 
         return {
             "status": "success",
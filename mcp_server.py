@@ -1,6 +1,12 @@
+import time
+
+INICIO_PROCESO = time.perf_counter()
+
 import json
 import logging
-from typing import Any, Union, List
+import threading
+from typing import Any, Union, List, Optional
+from urllib.parse import quote
 
 from mcp.server.fastmcp import FastMCP
 import requests
@@ -10,6 +16,20 @@ from dotenv import load_dotenv
 import os
 from redis import Redis
 
+from cache_warmer import CacheWarmer
+from places_cache import CACHE_STALE_TTL, PlacesCache, canonizar, clave_clapzy, clave_google
+from rate_limiter import (
+    PRIORIDAD_AUTH,
+    PRIORIDAD_GUEST,
+    UPSTREAM_CLAPZY,
+    UPSTREAM_GOOGLE,
+    RateLimited,
+    RateLimiter,
+    prioridad_sesion,
+)
+from result_store import FUENTE_CLAPZY, FUENTE_GOOGLE, ResultStore
+from spatial_index import SpatialIndexSync
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -20,14 +40,60 @@ GOOGLE_PLACES_API_KEY = os.getenv("GOOGLE_PLACES_API_KEY")
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
 
-# Conexión a Redis con manejo de errores
-try:
-    redis = Redis(host=REDIS_HOST, port=6379, db=0, decode_responses=True, socket_timeout=5, socket_connect_timeout=5)
-    redis.ping()
-    logger.info("✅ Redis conectado correctamente")
-except Exception as e:
-    logger.error(f"❌ Error conectando Redis: {e}")
-    redis = None
+# Conexión a Redis (perezosa: el cliente no conecta hasta la primera operación).
+# Misma URL que los clientes de la API, contraseña incluida
+REDIS_URL = (
+    f"redis://:{quote(REDIS_PASSWORD, safe='')}@{REDIS_HOST}:6379/0" if REDIS_PASSWORD else f"redis://{REDIS_HOST}:6379/0"
+)
+redis = Redis.from_url(REDIS_URL, decode_responses=True, socket_timeout=5, socket_connect_timeout=5)
+
+
+def verificar_redis():
+    """
+    Comprueba la conexión a Redis fuera del camino de arranque del servidor MCP.
+    Si falla se desactiva Redis (redis = None) y las herramientas, la caché y el rate limiter
+    pasan a sus caminos sin Redis en vez de esperar el timeout en cada operación.
+    """
+    global redis, places_cache, result_store, rate_limiter
+    try:
+        redis.ping()
+        logger.info("✅ Redis conectado correctamente")
+    except Exception as e:
+        logger.error(f"❌ Error conectando Redis, se continúa sin Redis: {e}")
+        redis = None
+        places_cache = PlacesCache(None)
+        result_store = ResultStore(None)
+        rate_limiter = RateLimiter(None)
+        indice_espacial.redis = None
+
+
+def iniciar_tareas_de_fondo():
+    """
+    Verifica Redis y después arranca el precalentador y el índice espacial,
+    que eligen su modo de funcionamiento según haya Redis o no.
+    """
+    verificar_redis()
+    CacheWarmer(
+        places_cache,
+        CIUDADES_CLAPZY,
+        TIPOS_ESTABLECIMIENTO,
+        consultar_clapzy_por_ciudad,
+        consultar_google_places,
+    ).start()
+    indice_espacial.start()
+
+places_cache = PlacesCache(redis)
+result_store = ResultStore(redis)
+rate_limiter = RateLimiter(redis)
+
+MENSAJE_ALTA_DEMANDA = "Error: Hay mucha demanda en este momento, no se pudo completar la búsqueda. Pide al usuario que lo intente en unos segundos."
+
+# Ciudades donde Clapzy maneja establecimientos y tipos de establecimiento de Clapzy
+CIUDADES_CLAPZY = ["Quito", "Bogotá", "Medellín", "Cali"]
+TIPOS_ESTABLECIMIENTO = ["Restaurante", "Bar y cocteles", "Música y fiesta", "Diversión y juegos", "Aventura al aire libre"]
+
+# Radio (km) de la búsqueda por coordenadas
+RADIO_BUSQUEDA_KM = 50
 
 #if DEVELOPMENT == 'True':
     # Configuración de proxy si es necesario
@@ -37,6 +103,11 @@ except Exception as e:
 mcp = FastMCP("mcp")
 
 
+def prioridad_token(token: str, session_id: str) -> str:
+    # Si token y session_id coinciden la sesión es de invitado
+    return PRIORIDAD_GUEST if token == session_id else PRIORIDAD_AUTH
+
+
 @mcp.tool()
 def recomendar_lugares_google_places(
     query: str = Field(
@@ -81,6 +152,59 @@ def recomendar_lugares_google_places(
     # print(f"""Session_id: {session_id}""")
     # print(f"""Place type: {place_type}""")
 
+    places_cache.registrar_query_google(query)
+
+    # Servir desde caché si la query ya está precalentada
+    cache_key = clave_google(query)
+    entrada = places_cache.get_con_fecha(cache_key)
+    places_cache.registrar_consulta(FUENTE_GOOGLE, entrada is not None)
+    if entrada is not None:
+        lugares, fetched_at = entrada
+        logger.info(f"⚡ Google Places servido desde caché: {query}")
+    else:
+        try:
+            lugares = consultar_google_places(query, prioridad_sesion(redis, session_id))
+            fetched_at = time.time()
+        except RateLimited as e:
+            # Bajo presión se sirve lo que haya en caché aunque no esté fresco
+            entrada = places_cache.get_con_fecha(cache_key, max_age=CACHE_STALE_TTL)
+            if entrada is None:
+                return MENSAJE_ALTA_DEMANDA
+            lugares, fetched_at = entrada
+            rate_limiter.registrar_cache_bajo_presion(e.upstream)
+            logger.info(f"🧊 Google Places servido desde caché por límite de cupo: {query}")
+        else:
+            if isinstance(lugares, str):
+                return lugares
+            places_cache.set(cache_key, lugares)
+
+    # Obtener los nombres de los lugares encontrados
+    nombres_lugares = [lugar["displayName"]["text"] for lugar in lugares]
+
+    # Guardar en Redis con manejo de errores
+    if redis is not None:
+        try:
+            redis.set(session_id, json.dumps(lugares), ex=3600)
+            redis.set(f"""{session_id}_query""", query, ex=3600)
+            result_store.guardar(session_id, FUENTE_GOOGLE, query, lugares, fetched_at)
+            logger.info(f"💾 Datos de Google Places guardados en Redis correctamente")
+        except Exception as e:
+            logger.error(f"❌ Error al guardar Google Places en Redis: {e}")
+    else:
+        logger.warning("⚠️ Redis no disponible para Google Places")
+
+    logger.info(f"✅ Google Places completado: {len(nombres_lugares)} lugares encontrados")
+    return nombres_lugares
+
+
+def consultar_google_places(query: str, prioridad: str = PRIORIDAD_AUTH) -> Union[str, List[dict]]:
+    """
+    Llama a Google Places Text Search y devuelve la lista de lugares,
+    o un mensaje de error si la solicitud falla.
+    Lanza RateLimited si no queda cupo de Google Places para la prioridad indicada.
+    """
+    rate_limiter.acquire(UPSTREAM_GOOGLE, GOOGLE_PLACES_API_KEY, prioridad)
+
     # Definir el cuerpo de la solicitud optimizado
     cuerpo = {
         "textQuery": query,
@@ -102,6 +226,8 @@ def recomendar_lugares_google_places(
             'places.id,'
             'places.photos,'
             'places.regularOpeningHours.weekdayDescriptions,'
+            'places.regularOpeningHours.periods,'
+            'places.utcOffsetMinutes,'
             'places.editorialSummary,'
             'places.internationalPhoneNumber,'
             'places.websiteUri,'
@@ -126,22 +252,7 @@ def recomendar_lugares_google_places(
     datos = respuesta.json()
     # print(f"""Datos: {datos}""")
 
-    # Obtener los nombres de los lugares encontrados
-    nombres_lugares = [lugar["displayName"]["text"] for lugar in datos["places"]]
-
-    # Guardar en Redis con manejo de errores
-    if redis is not None:
-        try:
-            redis.set(session_id, json.dumps(datos["places"]), ex=3600)
-            redis.set(f"""{session_id}_query""", query, ex=3600)
-            logger.info(f"💾 Datos de Google Places guardados en Redis correctamente")
-        except Exception as e:
-            logger.error(f"❌ Error al guardar Google Places en Redis: {e}")
-    else:
-        logger.warning("⚠️ Redis no disponible para Google Places")
-
-    logger.info(f"✅ Google Places completado: {len(nombres_lugares)} lugares encontrados")
-    return nombres_lugares
+    return datos.get("places", [])
 
 
 @mcp.tool()
@@ -150,7 +261,7 @@ def verificar_ciudades_clapzy(
         description="Nombre de la ciudad a verificar"
     ),
     lista_ciudades: List[str] = Field(
-        default = ["Quito", "Bogotá", "Medellín", "Cali"],
+        default = CIUDADES_CLAPZY,
         description="Lista de nombres de ciudades donde Clapzy maneja establecimientos"
     ),
     case_sensitive: bool = Field(
@@ -235,6 +346,71 @@ def buscar_establecimientos_clapzy_por_ciudad(
     logger.info(f"🏪 Tipo establecimiento: {establishment_type}")
     logger.info(f"📄 Page: {page}, Limit: {limit}")
 
+    # Servir desde caché si la combinación ciudad × tipo ya está precalentada. Los invitados
+    # comparten la entrada del modo invitado; cada usuario autenticado tiene la suya
+    # Nombres canónicos para que "Bogota" o "musica y fiesta" usen la entrada precalentada
+    city = canonizar(city, CIUDADES_CLAPZY)
+    establishment_type = canonizar(establishment_type, TIPOS_ESTABLECIMIENTO)
+    cache_key = clave_clapzy(city, establishment_type, page, limit, None if token == session_id else token)
+    entrada = places_cache.get_con_fecha(cache_key)
+    places_cache.registrar_consulta(FUENTE_CLAPZY, entrada is not None, prioridad_token(token, session_id))
+    if entrada is not None:
+        establecimientos, fetched_at = entrada
+        logger.info(f"⚡ Clapzy servido desde caché: {city} / {establishment_type}")
+    else:
+        try:
+            establecimientos = consultar_clapzy_por_ciudad(city, establishment_type, token, session_id, page, limit)
+            fetched_at = time.time()
+        except RateLimited as e:
+            # Bajo presión se sirve lo que haya en caché aunque no esté fresco
+            entrada = places_cache.get_con_fecha(cache_key, max_age=CACHE_STALE_TTL)
+            if entrada is None:
+                return MENSAJE_ALTA_DEMANDA
+            establecimientos, fetched_at = entrada
+            rate_limiter.registrar_cache_bajo_presion(e.upstream)
+            logger.info(f"🧊 Clapzy servido desde caché por límite de cupo: {city} / {establishment_type}")
+        else:
+            if isinstance(establecimientos, str):
+                return establecimientos
+            places_cache.set(cache_key, establecimientos)
+
+    try:
+        nombres_lugares = [lugar.get("name", "Sin nombre") for lugar in establecimientos if isinstance(lugar, dict)]
+        logger.info(f"📋 Procesados {len(nombres_lugares)} nombres de lugares")
+    except Exception as e:
+        logger.error(f"🔥 ERROR procesando nombres: {e}")
+        return f"Error al procesar nombres de lugares: {e}"
+
+    # Guardar los establecimientos en Redis
+    if redis is not None:
+        try:
+            redis.set(f"{session_id}_clapzy", json.dumps(establecimientos), ex=3600)
+            result_store.guardar(session_id, FUENTE_CLAPZY, f"{city} / {establishment_type}", establecimientos, fetched_at)
+            logger.info(f"💾 Datos guardados en Redis correctamente")
+        except Exception as e:
+            logger.error(f"❌ Error al guardar en Redis: {e}")
+            # No retornar error aquí, continuar con la respuesta
+    else:
+        logger.warning("⚠️ Redis no disponible, no se pueden guardar datos")
+
+    if not nombres_lugares:
+        logger.warning(f"🚫 No se encontraron establecimientos")
+        return f"No se encontraron establecimientos de tipo '{establishment_type}' en la ciudad de {city}"
+
+    logger.info(f"✅ === COMPLETADO: {len(nombres_lugares)} establecimientos encontrados ===")
+    return nombres_lugares
+
+
+def consultar_clapzy_por_ciudad(
+    city: str, establishment_type: str, token: str, session_id: str, page: int, limit: int, prioridad: str = None
+) -> Union[str, List[dict]]:
+    """
+    Llama al endpoint search_by_city de Clapzy y devuelve la lista de establecimientos,
+    o un mensaje de error si la solicitud falla.
+    Lanza RateLimited si no queda cupo de Clapzy para la prioridad (por defecto, la del token).
+    """
+    rate_limiter.acquire(UPSTREAM_CLAPZY, prioridad=prioridad or prioridad_token(token, session_id))
+
     # Parámetros de la solicitud
     params = {
         "city": city,
@@ -306,30 +482,7 @@ def buscar_establecimientos_clapzy_por_ciudad(
     else:
         logger.warning("❓ No se encontró estructura de datos conocida")
 
-    try:
-        nombres_lugares = [lugar.get("name", "Sin nombre") for lugar in establecimientos if isinstance(lugar, dict)]
-        logger.info(f"📋 Procesados {len(nombres_lugares)} nombres de lugares")
-    except Exception as e:
-        logger.error(f"🔥 ERROR procesando nombres: {e}")
-        return f"Error al procesar nombres de lugares: {e}"
-
-    # Guardar los establecimientos en Redis
-    if redis is not None:
-        try:
-            redis.set(f"{session_id}_clapzy", json.dumps(establecimientos), ex=3600)
-            logger.info(f"💾 Datos guardados en Redis correctamente")
-        except Exception as e:
-            logger.error(f"❌ Error al guardar en Redis: {e}")
-            # No retornar error aquí, continuar con la respuesta
-    else:
-        logger.warning("⚠️ Redis no disponible, no se pueden guardar datos")
-
-    if not nombres_lugares:
-        logger.warning(f"🚫 No se encontraron establecimientos")
-        return f"No se encontraron establecimientos de tipo '{establishment_type}' en la ciudad de {city}"
-
-    logger.info(f"✅ === COMPLETADO: {len(nombres_lugares)} establecimientos encontrados ===")
-    return nombres_lugares
+    return establecimientos
 
 
 
@@ -360,6 +513,7 @@ def buscar_establecimientos_clapzy_por_coordenadas(
                         "Token de acceso a la api de Clapzy"
                     )
                 ),
+    limit: int = Field(default=10, description="Número máximo de resultados"),
 ) -> Union[str, List[str], List[Any]]:
     """
     Realiza una búsqueda de lugares basada en la consulta proporcionada por el usuario,
@@ -371,6 +525,7 @@ def buscar_establecimientos_clapzy_por_coordenadas(
     - session_id (str): Cadena de texto para usar como clave en la base de datos de redis.
     - establishment_type (str): Cadena de texto para clasificar lugar a buscar puede ser una de estas opciones: ('Restaurante', 'Bar y cocteles', 'Música y fiesta', 'Diversión y juegos','Aventura al aire libre').
     - token (str): Token de acceso a la api de Clapzy.
+    - limit (int): Número máximo de resultados (los más cercanos).
 
     Retorna:
     - Una lista de nombres de lugares encontrados que coinciden con la consulta del usuario.
@@ -383,12 +538,95 @@ def buscar_establecimientos_clapzy_por_coordenadas(
     logger.info(f"🔑 Session_id: {session_id}")
     logger.info(f"🏪 Tipo establecimiento: {establishment_type}")
 
+    # Resolver con el índice espacial local; el backend solo se usa si no hay índice o no hay resultados.
+    # El índice se llena en modo invitado, así que solo responde a sesiones invitadas (igual que la caché)
+    establecimientos = None
+    if token == session_id:
+        establecimientos = buscar_en_indice_espacial(latitude, longitude, establishment_type, limit)
+    fetched_at = indice_espacial.actualizado_en
+    if establecimientos is None:
+        try:
+            establecimientos = consultar_clapzy_por_coordenadas(latitude, longitude, establishment_type, token, session_id)
+            fetched_at = time.time()
+        except RateLimited:
+            return MENSAJE_ALTA_DEMANDA
+        if isinstance(establecimientos, str):
+            return establecimientos
+
+    try:
+        nombres_lugares = [lugar.get("name", "Sin nombre") for lugar in establecimientos if isinstance(lugar, dict)]
+        logger.info(f"📋 Procesados {len(nombres_lugares)} nombres de lugares (coordenadas)")
+    except Exception as e:
+        logger.error(f"🔥 ERROR procesando nombres (coordenadas): {e}")
+        return f"Error al procesar nombres de lugares: {e}"
+
+    # Guardar en Redis
+    if redis is not None:
+        try:
+            redis.set(f"""{session_id}_clapzy""", json.dumps(establecimientos), ex=3600)
+            result_store.guardar(session_id, FUENTE_CLAPZY, f"{latitude},{longitude} / {establishment_type}", establecimientos, fetched_at)
+            logger.info(f"💾 Datos guardados en Redis correctamente (coordenadas)")
+        except Exception as e:
+            logger.error(f"❌ Error al guardar en Redis (coordenadas): {e}")
+            # No retornar error aquí, continuar con la respuesta
+    else:
+        logger.warning("⚠️ Redis no disponible (coordenadas)")
+
+    if not nombres_lugares:
+        logger.warning(f"🚫 No se encontraron establecimientos (coordenadas)")
+        return f"No se encontraron establecimientos de tipo '{establishment_type}' en las coordenadas especificadas"
+
+    logger.info(f"✅ === COMPLETADO (coordenadas): {len(nombres_lugares)} establecimientos encontrados ===")
+    return nombres_lugares
+
+
+def buscar_en_indice_espacial(
+    latitude: str, longitude: str, establishment_type: str, limit: int = 10
+) -> Union[None, List[dict]]:
+    """
+    Busca en el índice espacial local los limit establecimientos más cercanos dentro del radio,
+    ordenados por distancia.
+    Devuelve None si el índice aún no está cargado, las coordenadas no son válidas o no hay resultados.
+    """
+    index = indice_espacial.index
+    if index is None or len(index) == 0:
+        return None
+
+    try:
+        lat, lon = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        logger.warning(f"⚠️ Coordenadas no numéricas, se consulta el backend: {latitude}, {longitude}")
+        return None
+
+    inicio = time.perf_counter()
+    establecimientos = [
+        establecimiento
+        for establecimiento in index.cercanos(lat, lon, limit, establishment_type)
+        if establecimiento["distance_km"] <= RADIO_BUSQUEDA_KM
+    ]
+    logger.info(
+        f"⚡ Índice espacial: {len(establecimientos)} establecimientos en "
+        f"{(time.perf_counter() - inicio) * 1000:.3f}ms (coordenadas)"
+    )
+    return establecimientos or None
+
+
+def consultar_clapzy_por_coordenadas(
+    latitude: str, longitude: str, establishment_type: str, token: str, session_id: str
+) -> Union[str, List[dict]]:
+    """
+    Llama al endpoint coordenates de Clapzy y devuelve la lista de establecimientos,
+    o un mensaje de error si la solicitud falla.
+    Lanza RateLimited si no queda cupo de Clapzy para la prioridad del token.
+    """
+    rate_limiter.acquire(UPSTREAM_CLAPZY, prioridad=prioridad_token(token, session_id))
+
     # Definir el cuerpo de la solicitud
     cuerpo = {
         "latitude": latitude,
         "longitude": longitude,
         "establishment_type": establishment_type,
-        "radius": 50
+        "radius": RADIO_BUSQUEDA_KM
     }
 
     # Encabezados de la solicitud
@@ -444,33 +682,108 @@ def buscar_establecimientos_clapzy_por_coordenadas(
     establecimientos = datos["establishments"]
     logger.info(f"🏪 Establecimientos encontrados (coordenadas): {len(establecimientos)}")
 
+    return establecimientos
+
+
+@mcp.tool()
+def refinar_resultados_anteriores(
+    session_id: str = Field(
+        description="ID de sesión cuyos resultados anteriores se van a refinar"
+    ),
+    nivel_precio_max: Optional[int] = Field(
+        default=None,
+        description="Nivel de precio máximo (1 barato, 2 medio, 3 alto, 4 muy alto). Para 'menos costoso' usa un nivel menos que el anterior"
+    ),
+    nivel_precio_min: Optional[int] = Field(
+        default=None,
+        description="Nivel de precio mínimo (1 barato, 2 medio, 3 alto, 4 muy alto)"
+    ),
+    rating_min: Optional[float] = Field(
+        default=None,
+        description="Rating mínimo (por ejemplo 4.3)"
+    ),
+    tipo: Optional[str] = Field(
+        default=None,
+        description="Tipo de lugar a conservar, por ejemplo 'bar', 'night_club', 'restaurant' o un tipo de Clapzy"
+    ),
+    abierto_ahora: bool = Field(
+        default=False,
+        description="Si es True, solo lugares abiertos en este momento"
+    ),
+    excluir: List[str] = Field(
+        default=[],
+        description="Nombres de lugares que ya recomendaste y no se deben repetir"
+    ),
+) -> Union[str, List[str]]:
+    """
+    Refina los últimos resultados de búsqueda de la sesión sin hacer una búsqueda nueva.
+
+    Úsala para pedidos como "menos costoso", cambios de presupuesto, "solo los que estén abiertos",
+    "con mejor rating" o "no repitas lugares". Filtra localmente los lugares ya obtenidos por
+    recomendar_lugares_google_places y las búsquedas de Clapzy, y nunca repite lugares que ya devolvió.
+
+    Retorna:
+    - Una lista de nombres de lugares que cumplen los filtros.
+    - Un mensaje indicando que no quedan lugares; en ese caso haz una búsqueda nueva.
+    """
+
+    logger.info(f"🔎 === INICIANDO refinar_resultados_anteriores ({session_id}) ===")
+
+    if redis is None:
+        logger.warning("⚠️ Redis no disponible, no hay resultados anteriores que refinar")
+        return "No hay resultados anteriores disponibles. Haz una búsqueda nueva con las herramientas de búsqueda."
+
     try:
-        nombres_lugares = [lugar.get("name", "Sin nombre") for lugar in establecimientos if isinstance(lugar, dict)]
-        logger.info(f"📋 Procesados {len(nombres_lugares)} nombres de lugares (coordenadas)")
+        resultado = result_store.refinar(
+            session_id,
+            precio_min=nivel_precio_min,
+            precio_max=nivel_precio_max,
+            rating_min=rating_min,
+            tipo=tipo,
+            abierto_ahora=abierto_ahora,
+            excluir=excluir,
+        )
     except Exception as e:
-        logger.error(f"🔥 ERROR procesando nombres (coordenadas): {e}")
-        return f"Error al procesar nombres de lugares: {e}"
-
-    # Guardar en Redis
-    if redis is not None:
-        try:
-            redis.set(f"""{session_id}_clapzy""", json.dumps(establecimientos), ex=3600)
-            logger.info(f"💾 Datos guardados en Redis correctamente (coordenadas)")
-        except Exception as e:
-            logger.error(f"❌ Error al guardar en Redis (coordenadas): {e}")
-            # No retornar error aquí, continuar con la respuesta
-    else:
-        logger.warning("⚠️ Redis no disponible (coordenadas)")
+        logger.error(f"❌ Error refinando resultados: {e}")
+        return "No se pudieron refinar los resultados anteriores. Haz una búsqueda nueva."
+
+    lugares_google = resultado[FUENTE_GOOGLE]
+    lugares_clapzy = resultado[FUENTE_CLAPZY]
+    if not lugares_google and not lugares_clapzy:
+        logger.info("🚫 Resultados locales agotados, hace falta una búsqueda nueva")
+        return (
+            "No quedan lugares en los resultados anteriores que cumplan esos filtros. "
+            "Haz una búsqueda nueva con las herramientas de búsqueda."
+        )
 
-    if not nombres_lugares:
-        logger.warning(f"🚫 No se encontraron establecimientos (coordenadas)")
-        return f"No se encontraron establecimientos de tipo '{establishment_type}' en las coordenadas especificadas"
+    # Guardar en las mismas claves que las búsquedas para que la API devuelva los lugares,
+    # e indicar en {session_id}_refined qué fuentes se escribieron en este turno
+    try:
+        fuentes = []
+        if lugares_google:
+            redis.set(session_id, json.dumps(lugares_google), ex=3600)
+            fuentes.append(FUENTE_GOOGLE)
+        if lugares_clapzy:
+            redis.set(f"{session_id}_clapzy", json.dumps(lugares_clapzy), ex=3600)
+            fuentes.append(FUENTE_CLAPZY)
+        redis.sadd(f"{session_id}_refined", *fuentes)
+        redis.expire(f"{session_id}_refined", 3600)
+    except Exception as e:
+        logger.error(f"❌ Error al guardar resultados refinados en Redis: {e}")
 
-    logger.info(f"✅ === COMPLETADO (coordenadas): {len(nombres_lugares)} establecimientos encontrados ===")
+    nombres_lugares = [lugar["displayName"]["text"] for lugar in lugares_google]
+    nombres_lugares += [lugar.get("name", "Sin nombre") for lugar in lugares_clapzy]
+    logger.info(f"✅ Refinamiento local: {len(nombres_lugares)} lugares sin llamar a APIs externas")
     return nombres_lugares
 
 
+# Índice espacial local de establecimientos Clapzy (se sincroniza en segundo plano)
+indice_espacial = SpatialIndexSync(redis, CIUDADES_CLAPZY, TIPOS_ESTABLECIMIENTO, consultar_clapzy_por_ciudad)
+
+
 if __name__ == "__main__":
     logger.info("🚀 === INICIANDO MCP SERVER ===")
     logger.info("📡 Transporte: STDIO")
+    threading.Thread(target=iniciar_tareas_de_fondo, name="background-start", daemon=True).start()
+    logger.info(f"⏱️ MCP server listo para initialize en {(time.perf_counter() - INICIO_PROCESO) * 1000:.0f}ms")
     mcp.run(transport="stdio")
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+from collections import deque
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import RunnableLambda
+
+logger = logging.getLogger(__name__)
+
+# Modelo rápido para turnos ligeros; si no se configura, todo va al modelo principal
+OPENAI_API_MODEL_LIGHT = os.getenv("OPENAI_API_MODEL_LIGHT")
+MODEL_MAIN_TIMEOUT = float(os.getenv("MODEL_MAIN_TIMEOUT", "60"))
+MODEL_LIGHT_TIMEOUT = float(os.getenv("MODEL_LIGHT_TIMEOUT", "15"))
+
+ROUTE_MAIN = "main"
+ROUTE_LIGHT = "light"
+
+# Herramientas cuyo resultado ya es la lista final de lugares: el siguiente paso es redactar
+SEARCH_TOOLS = {
+    "recomendar_lugares_google_places",
+    "buscar_establecimientos_clapzy_por_ciudad",
+    "buscar_establecimientos_clapzy_por_coordenadas",
+    "refinar_resultados_anteriores",
+}
+
+# Palabras que indican que hay que planificar una búsqueda (se comparan sin tildes)
+SEARCH_HINTS = re.compile(
+    r"\b(restaurant\w*|bar|bares|club\w*|discotec\w*|cena\w*|cenar|comer|comida|almuerz\w*|desayun\w*|"
+    r"cafe\w*|plan|planes|lugar\w*|sitio\w*|spot\w*|busca\w*|recomienda\w*|recomendaci\w*|fiesta|rumba|"
+    r"coctel\w*|cocktail\w*|musica|aventura|juegos|ciudad|cerca|zona|barrio|barato\w*|costos\w*|caro\w*|"
+    r"precio\w*|presupuesto|otro\w*|otra\w*|mas|menos|opcion\w*|en|where|find|near|cheap\w*)\b"
+)
+SMALL_TALK = re.compile(
+    r"^(hola\w*|hey|buenas|buenos dias|buenas (tardes|noches)|que tal|como estas|gracias|muchas gracias|"
+    r"ok|okay|vale|listo|genial|perfecto|super|bien|chevere|bacan\w*|jaja\w*|jeje\w*|si|no|claro|"
+    r"chao|adios|bye|hasta luego|nos vemos|thanks|thank you|hi|hello)\b"
+)
+SMALL_TALK_MAX_WORDS = 6
+
+
+def _normalizar(texto: str) -> str:
+    texto = unicodedata.normalize("NFD", str(texto).lower())
+    return "".join(c for c in texto if unicodedata.category(c) != "Mn").strip(" ¿¡!?.,")
+
+
+def _tool_returned_results(message: ToolMessage) -> bool:
+    """
+    True si la herramienta devolvió una lista no vacía de lugares. Los errores, "no se
+    encontraron" o "haz una búsqueda nueva" llegan como texto y exigen planificar otra llamada.
+    """
+    content = message.content
+    if isinstance(content, str):
+        try:
+            content = json.loads(content)
+        except ValueError:
+            return False
+    return isinstance(content, list) and len(content) > 0
+
+
+def classify_turn(messages) -> str:
+    """
+    Decide qué modelo atiende el siguiente paso del agente, sin llamar a ningún modelo.
+
+    - Tras una herramienta de búsqueda que devolvió lugares solo queda redactarlos: modelo
+      ligero. Si devolvió un error o ningún lugar hay que planificar: modelo principal.
+    - Saludos, agradecimientos y charla corta sin intención de búsqueda: modelo ligero,
+      salvo que GAIA acabe de preguntar algo (la respuesta suele desencadenar una búsqueda).
+    - Todo lo demás (planificar herramientas, dudas): modelo principal.
+    """
+    if not messages:
+        return ROUTE_MAIN
+
+    last = messages[-1]
+    if isinstance(last, ToolMessage):
+        return ROUTE_LIGHT if last.name in SEARCH_TOOLS and _tool_returned_results(last) else ROUTE_MAIN
+
+    if isinstance(last, HumanMessage) and isinstance(last.content, str):
+        texto = _normalizar(last.content)
+        if SEARCH_HINTS.search(texto):
+            return ROUTE_MAIN
+        previous = messages[-2] if len(messages) > 1 else None
+        answering_question = isinstance(previous, AIMessage) and "?" in str(previous.content)
+        if not answering_question and len(texto.split()) <= SMALL_TALK_MAX_WORDS and SMALL_TALK.match(texto):
+            return ROUTE_LIGHT
+
+    return ROUTE_MAIN
+
+
+class RouteMetrics:
+    """
+    Latencia y tokens por ruta (ventana de las últimas llamadas para los percentiles).
+    """
+
+    def __init__(self, window: int = 500):
+        self.calls = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.timeouts = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.latencies = deque(maxlen=window)
+
+    def record(self, elapsed: float, message):
+        self.calls += 1
+        self.latencies.append(elapsed)
+        usage = getattr(message, "usage_metadata", None) or {}
+        self.input_tokens += usage.get("input_tokens", 0)
+        self.output_tokens += usage.get("output_tokens", 0)
+
+    def stats(self) -> dict:
+        latencias = sorted(self.latencies)
+
+        def percentil(p):
+            if not latencias:
+                return 0.0
+            return round(latencias[min(int(len(latencias) * p), len(latencias) - 1)] * 1000, 1)
+
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "fallbacks": self.fallbacks,
+            "latency_avg_ms": round(sum(latencias) / len(latencias) * 1000, 1) if latencias else 0.0,
+            "latency_p50_ms": percentil(0.5),
+            "latency_p95_ms": percentil(0.95),
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "avg_output_tokens": round(self.output_tokens / self.calls, 1) if self.calls else 0.0,
+        }
+
+
+class ModelRouter:
+    """
+    Selecciona el modelo de cada paso del agente según classify_turn.
+
+    Cada ruta tiene su propio timeout y usa la otra ruta como fallback si falla o se agota.
+    Se pasa a create_react_agent como modelo dinámico: select(state, runtime).
+    """
+
+    def __init__(self, main_model, light_model=None):
+        self.models = {ROUTE_MAIN: main_model, ROUTE_LIGHT: light_model or main_model}
+        self.timeouts = {ROUTE_MAIN: MODEL_MAIN_TIMEOUT, ROUTE_LIGHT: MODEL_LIGHT_TIMEOUT}
+        self.enabled = light_model is not None
+        self.metrics = {ROUTE_MAIN: RouteMetrics(), ROUTE_LIGHT: RouteMetrics()}
+        self.bound = {}
+        self.runnables = {}
+
+    def bind_tools(self, tools):
+        self.bound = {route: model.bind_tools(tools) for route, model in self.models.items()}
+        self.runnables = {
+            route: RunnableLambda(self._async_caller(route), name=f"model_{route}")
+            for route in self.models
+        }
+        return self
+
+    def select(self, state, runtime=None):
+        route = classify_turn(state["messages"]) if self.enabled else ROUTE_MAIN
+        return self.runnables[route]
+
+    @staticmethod
+    def _fallback_route(route: str) -> str:
+        return ROUTE_LIGHT if route == ROUTE_MAIN else ROUTE_MAIN
+
+    def _async_caller(self, route: str):
+        async def call(messages, config):
+            try:
+                return await self._ainvoke_route(route, messages, config)
+            except Exception as e:
+                if not self.enabled:
+                    raise
+                fallback = self._fallback_route(route)
+                logger.warning(f"⚠️ Modelo '{route}' falló ({type(e).__name__}: {e}), usando '{fallback}'")
+                self.metrics[route].fallbacks += 1
+                return await self._ainvoke_route(fallback, messages, config)
+
+        return call
+
+    async def _ainvoke_route(self, route: str, messages, config) -> AIMessage:
+        metrics = self.metrics[route]
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(self.bound[route].ainvoke(messages, config), timeout=self.timeouts[route])
+        except asyncio.TimeoutError:
+            metrics.timeouts += 1
+            raise
+        except Exception:
+            metrics.errors += 1
+            raise
+        metrics.record(time.perf_counter() - started, result)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "routes": {route: metrics.stats() for route, metrics in self.metrics.items()},
+        }
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import unicodedata
+from datetime import datetime, timedelta
+from typing import Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Edad máxima (segundos) para considerar fresca una entrada y tiempo de vida total en Redis
+CACHE_FRESH_TTL = int(os.getenv("CACHE_FRESH_TTL", "86400"))
+CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", "172800"))
+
+# Frecuencia de queries de Google en conjuntos diarios: solo cuentan los últimos días
+GOOGLE_FREQ_KEY = "cache:google:freq:{}"
+GOOGLE_FREQ_WINDOW_DAYS = int(os.getenv("GOOGLE_FREQ_WINDOW_DAYS", "7"))
+# Aciertos/fallos de caché por fuente, modo de acceso y hora (para ver cuánto cubre el precalentamiento)
+CACHE_METRICS_KEY = "cache:metrics:{}"
+CACHE_METRICS_TTL = int(os.getenv("CACHE_METRICS_TTL", "604800"))
+
+
+def _normalizar(texto: str) -> str:
+    # Sin tildes: "Bogota" y "Bogotá" comparten entrada
+    texto = unicodedata.normalize("NFD", str(texto).strip().lower())
+    texto = "".join(c for c in texto if unicodedata.category(c) != "Mn")
+    return " ".join(texto.split())
+
+
+def canonizar(texto: str, opciones: List[str]) -> str:
+    """
+    Devuelve la opción que coincide con texto sin tener en cuenta mayúsculas, tildes ni
+    espacios (por ejemplo "medellin" -> "Medellín"), o el propio texto si ninguna coincide.
+    """
+    normalizado = _normalizar(texto)
+    for opcion in opciones:
+        if _normalizar(opcion) == normalizado:
+            return opcion
+    return texto
+
+
+def clave_google(query: str) -> str:
+    return f"cache:google:{_normalizar(query)}"
+
+
+def clave_clapzy(city: str, establishment_type: str, page: int, limit: int, token: Optional[str] = None) -> str:
+    """
+    Sin token la clave es la del modo invitado, compartida por todas las sesiones invitadas
+    (es la que se precalienta). Con token la clave es propia de ese usuario autenticado.
+    """
+    modo = f"auth:{hashlib.sha1(token.encode()).hexdigest()[:12]}" if token else "guest"
+    return f"cache:clapzy:{modo}:{_normalizar(city)}:{_normalizar(establishment_type)}:{page}:{limit}"
+
+
+class PlacesCache:
+    """
+    Caché compartida en Redis para resultados de Google Places y Clapzy.
+
+    Cada entrada guarda el momento en que se obtuvo, de modo que quien lee decide
+    qué antigüedad acepta. Si Redis no está disponible todas las operaciones son no-op.
+
+    Solo las entradas de invitados (y las de Google, que no dependen del usuario) se
+    precalientan: las de Clapzy de usuarios autenticados son propias de cada token y solo
+    aciertan si ese mismo usuario repite la búsqueda. registrar_consulta mide la cobertura.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def get(self, key: str, max_age: int = CACHE_FRESH_TTL) -> Optional[Any]:
+        entrada = self.get_con_fecha(key, max_age)
+        return entrada[0] if entrada is not None else None
+
+    def get_con_fecha(self, key: str, max_age: int = CACHE_FRESH_TTL) -> Optional[Tuple[Any, float]]:
+        """
+        Como get, pero devuelve (datos, fetched_at) para quien necesita saber su antigüedad.
+        """
+        if self.redis is None:
+            return None
+        try:
+            raw = self.redis.get(key)
+        except Exception as e:
+            logger.error(f"❌ Error leyendo caché {key}: {e}")
+            return None
+        if not raw:
+            return None
+        entrada = json.loads(raw)
+        if time.time() - entrada["fetched_at"] > max_age:
+            return None
+        return entrada["data"], entrada["fetched_at"]
+
+    def age(self, key: str) -> Optional[float]:
+        if self.redis is None:
+            return None
+        try:
+            raw = self.redis.get(key)
+        except Exception as e:
+            logger.error(f"❌ Error leyendo caché {key}: {e}")
+            return None
+        if not raw:
+            return None
+        return time.time() - json.loads(raw)["fetched_at"]
+
+    def set(self, key: str, data: Any):
+        if self.redis is None:
+            return
+        try:
+            entrada = {"fetched_at": time.time(), "data": data}
+            self.redis.set(key, json.dumps(entrada), ex=CACHE_STALE_TTL)
+        except Exception as e:
+            logger.error(f"❌ Error guardando caché {key}: {e}")
+
+    def registrar_query_google(self, query: str):
+        """
+        Cuenta cuántas veces se pide cada query de Google para saber cuáles precalentar.
+        Cada día tiene su propio conjunto, que expira cuando sale de la ventana.
+        """
+        if self.redis is None:
+            return
+        key = GOOGLE_FREQ_KEY.format(datetime.now().strftime("%Y%m%d"))
+        try:
+            pipe = self.redis.pipeline()
+            pipe.zincrby(key, 1, _normalizar(query))
+            pipe.expire(key, (GOOGLE_FREQ_WINDOW_DAYS + 1) * 86400)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"❌ Error registrando frecuencia de query: {e}")
+
+    def queries_google_frecuentes(self, n: int) -> List[str]:
+        """
+        Las n queries más pedidas en los últimos GOOGLE_FREQ_WINDOW_DAYS días.
+        """
+        if self.redis is None or n <= 0:
+            return []
+        hoy = datetime.now()
+        dias = [
+            GOOGLE_FREQ_KEY.format((hoy - timedelta(days=i)).strftime("%Y%m%d"))
+            for i in range(GOOGLE_FREQ_WINDOW_DAYS)
+        ]
+        ventana = GOOGLE_FREQ_KEY.format("window")
+        try:
+            pipe = self.redis.pipeline()
+            pipe.zunionstore(ventana, dias)
+            pipe.expire(ventana, 60)
+            pipe.zrevrange(ventana, 0, n - 1)
+            return list(pipe.execute()[-1])
+        except Exception as e:
+            logger.error(f"❌ Error leyendo queries frecuentes: {e}")
+            return []
+
+    def registrar_consulta(self, fuente: str, acierto: bool, modo: str = None):
+        """
+        Cuenta un acierto o fallo de caché, en total y por hora del día, para medir qué
+        parte del tráfico (y del tráfico en hora punta) se sirve sin llamar al upstream.
+        """
+        if self.redis is None:
+            return
+        resultado = "hit" if acierto else "miss"
+        prefijo = f"{modo}:" if modo else ""
+        key = CACHE_METRICS_KEY.format(fuente)
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hincrby(key, f"{prefijo}{resultado}", 1)
+            pipe.hincrby(key, f"h{datetime.now().hour:02d}:{prefijo}{resultado}", 1)
+            pipe.expire(key, CACHE_METRICS_TTL)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"❌ Error registrando métricas de caché: {e}")
+
+
+def snapshot(redis, fuentes=("google", "clapzy")) -> dict:
+    """
+    Aciertos, fallos y ratio de acierto por fuente y modo, en total y por hora (para /metrics).
+    """
+    resultado = {}
+    for fuente in fuentes:
+        try:
+            contadores = {k: int(v) for k, v in (redis.hgetall(CACHE_METRICS_KEY.format(fuente)) or {}).items()}
+        except Exception:
+            contadores = {}
+        grupos = {}
+        for campo, valor in contadores.items():
+            grupo, _, tipo = campo.rpartition(":")
+            grupos.setdefault(grupo or "total", {"hit": 0, "miss": 0})[tipo] = valor
+        for grupo in grupos.values():
+            total = grupo["hit"] + grupo["miss"]
+            grupo["hit_ratio"] = round(grupo["hit"] / total, 3) if total else None
+        resultado[fuente] = grupos
+    return resultado
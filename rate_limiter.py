@@ -0,0 +1,215 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_GOOGLE = "google_places"
+UPSTREAM_CLAPZY = "clapzy"
+
+PRIORIDAD_AUTH = "auth"
+PRIORIDAD_GUEST = "guest"
+PRIORIDAD_BACKGROUND = "background"
+
+# Ritmo sostenido (peticiones/segundo) y ráfaga máxima por upstream, compartidos por todo el clúster
+LIMITES = {
+    UPSTREAM_GOOGLE: (
+        float(os.getenv("GOOGLE_PLACES_RATE", "5")),
+        float(os.getenv("GOOGLE_PLACES_BURST", "20")),
+    ),
+    UPSTREAM_CLAPZY: (
+        float(os.getenv("CLAPZY_RATE", "10")),
+        float(os.getenv("CLAPZY_BURST", "30")),
+    ),
+}
+
+# Fracción del bucket que cada prioridad debe dejar libre: los invitados no pueden agotar
+# el cupo de los usuarios autenticados, y las tareas de fondo ceden ante ambos
+RESERVAS = {
+    PRIORIDAD_AUTH: 0.0,
+    PRIORIDAD_GUEST: float(os.getenv("RATE_LIMIT_GUEST_RESERVE", "0.2")),
+    PRIORIDAD_BACKGROUND: float(os.getenv("RATE_LIMIT_BACKGROUND_RESERVE", "0.5")),
+}
+
+# Token bucket atómico: devuelve {permitido, tokens restantes}. Usa la hora del servidor
+# Redis para que todas las réplicas compartan el mismo reloj.
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local reserve = tonumber(ARGV[4])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+if cost == 0 or tokens - cost >= reserve then
+    tokens = tokens - cost
+    allowed = 1
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RateLimited(Exception):
+    """
+    Se lanza cuando un upstream no tiene cupo disponible para la prioridad pedida.
+    """
+
+    def __init__(self, upstream: str, prioridad: str):
+        super().__init__(f"Cupo agotado para {upstream} ({prioridad})")
+        self.upstream = upstream
+        self.prioridad = prioridad
+
+
+class _LocalBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, cost: float, reserve: float):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            allowed = cost == 0 or self.tokens - cost >= reserve
+            if allowed:
+                self.tokens -= cost
+            return allowed, self.tokens
+
+
+def _clave_api(api_key) -> str:
+    if not api_key:
+        return "default"
+    return hashlib.sha1(str(api_key).encode()).hexdigest()[:12]
+
+
+class RateLimiter:
+    """
+    Limitador token-bucket por upstream y API key, compartido en Redis entre réplicas.
+
+    Si Redis falla se usa un bucket en memoria del proceso con los mismos límites,
+    de modo que una caída de Redis no deja las APIs externas sin protección.
+    Los contadores de peticiones permitidas y estranguladas se guardan en Redis.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._script = redis.register_script(TOKEN_BUCKET_LUA) if redis is not None else None
+        self._locales = {}
+        self._locales_lock = threading.Lock()
+
+    def _bucket_key(self, upstream: str, api_key) -> str:
+        return f"ratelimit:{upstream}:{_clave_api(api_key)}"
+
+    def _local(self, bucket_key: str, rate: float, capacity: float) -> _LocalBucket:
+        with self._locales_lock:
+            if bucket_key not in self._locales:
+                self._locales[bucket_key] = _LocalBucket(rate, capacity)
+            return self._locales[bucket_key]
+
+    def _take(self, upstream: str, api_key, cost: float, reserve_fraction: float):
+        rate, capacity = LIMITES[upstream]
+        bucket_key = self._bucket_key(upstream, api_key)
+        reserve = capacity * reserve_fraction
+        if self._script is not None:
+            try:
+                allowed, tokens = self._script(keys=[bucket_key], args=[rate, capacity, cost, reserve])
+                return bool(allowed), float(tokens), False
+            except Exception as e:
+                logger.error(f"❌ Error en rate limiter Redis, usando bucket local: {e}")
+        allowed, tokens = self._local(bucket_key, rate, capacity).take(cost, reserve)
+        return allowed, tokens, True
+
+    def _contar(self, upstream: str, *campos):
+        if self.redis is None:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            for campo in campos:
+                pipe.hincrby(f"ratelimit:metrics:{upstream}", campo, 1)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"❌ Error registrando métricas de rate limit: {e}")
+
+    def acquire(self, upstream: str, api_key=None, prioridad: str = PRIORIDAD_AUTH):
+        """
+        Consume un token del bucket o lanza RateLimited si no hay cupo para esa prioridad.
+        """
+        allowed, tokens, local = self._take(upstream, api_key, 1, RESERVAS[prioridad])
+        campos = ["allowed" if allowed else "throttled", f"{'allowed' if allowed else 'throttled'}_{prioridad}"]
+        if local:
+            campos.append("local_fallback")
+        self._contar(upstream, *campos)
+        if not allowed:
+            logger.warning(f"🚦 {upstream} estrangulado para '{prioridad}' (quedan {tokens:.1f} tokens)")
+            raise RateLimited(upstream, prioridad)
+
+    def registrar_cache_bajo_presion(self, upstream: str):
+        self._contar(upstream, "served_from_cache")
+
+    def remaining(self, upstream: str, api_key=None):
+        """
+        Tokens disponibles ahora mismo en el bucket compartido, o None si Redis no responde.
+        """
+        rate, capacity = LIMITES[upstream]
+        if self._script is None:
+            return None
+        try:
+            _, tokens = self._script(keys=[self._bucket_key(upstream, api_key)], args=[rate, capacity, 0, 0])
+            return round(float(tokens), 2)
+        except Exception as e:
+            logger.error(f"❌ Error leyendo cupo restante de {upstream}: {e}")
+            return None
+
+
+def registrar_prioridad_sesion(redis, session_id: str, token: str):
+    """
+    Guarda si la sesión es de invitado (token == session_id) o autenticada, para que las
+    herramientas que no reciben el token (Google Places) puedan priorizar igual.
+    """
+    prioridad = PRIORIDAD_GUEST if token == session_id else PRIORIDAD_AUTH
+    try:
+        redis.set(f"{session_id}_priority", prioridad, ex=3600)
+    except Exception as e:
+        logger.error(f"❌ Error guardando prioridad de sesión: {e}")
+
+
+def prioridad_sesion(redis, session_id: str) -> str:
+    try:
+        return redis.get(f"{session_id}_priority") or PRIORIDAD_GUEST
+    except Exception:
+        return PRIORIDAD_GUEST
+
+
+def snapshot(redis, api_keys: dict = None) -> dict:
+    """
+    Cupo restante y contadores de estrangulamiento por upstream (para /metrics).
+    """
+    limiter = RateLimiter(redis)
+    api_keys = api_keys or {}
+    resultado = {}
+    for upstream, (rate, capacity) in LIMITES.items():
+        try:
+            contadores = {k: int(v) for k, v in (redis.hgetall(f"ratelimit:metrics:{upstream}") or {}).items()}
+        except Exception:
+            contadores = {}
+        resultado[upstream] = {
+            "rate_per_second": rate,
+            "burst": capacity,
+            "remaining": limiter.remaining(upstream, api_keys.get(upstream)),
+            **contadores,
+        }
+    return resultado
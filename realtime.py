@@ -0,0 +1,126 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Optional
+
+from fastapi import WebSocket
+from fastapi.encoders import jsonable_encoder
+from starlette.websockets import WebSocketState
+
+from events import EVENTS_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+# Segundos que tiene el cliente para enviar el mensaje de autenticación tras conectar
+WS_AUTH_TIMEOUT = float(os.getenv("WS_AUTH_TIMEOUT", "10"))
+# Turnos que una conexión puede tener pendientes a la vez (el resto se rechaza con 429)
+WS_MAX_PENDING_TURNS = int(os.getenv("WS_MAX_PENDING_TURNS", "3"))
+
+
+class ChatConnection:
+    """
+    Estado de una conexión WebSocket autenticada: la sesión, su config del agente y si el
+    hilo ya tiene saludo, para no volver a resolverlos en cada turno.
+
+    Los envíos se serializan con un lock porque los turnos y los eventos del servidor
+    escriben en el mismo socket desde tareas distintas.
+    """
+
+    def __init__(self, websocket: WebSocket, session_id: str, token: str, config: dict):
+        self.websocket = websocket
+        self.session_id = session_id
+        self.token = token
+        self.config = config
+        self.started = False
+        self.pending_turns = 0
+        self.tasks = set()
+        self.running_task: Optional[asyncio.Task] = None
+        self._send_lock = asyncio.Lock()
+
+    @property
+    def open(self) -> bool:
+        return self.websocket.client_state == WebSocketState.CONNECTED
+
+    async def send(self, tipo: str, **datos) -> bool:
+        if not self.open:
+            return False
+        try:
+            async with self._send_lock:
+                await self.websocket.send_json(jsonable_encoder({"type": tipo, **datos}))
+            return True
+        except Exception as e:
+            logger.debug(f"Conexión {self.session_id} cerrada al enviar '{tipo}': {e}")
+            return False
+
+    async def push_event(self, evento: dict) -> bool:
+        return await self.send("event", **evento)
+
+
+class EventHub:
+    """
+    Suscripción única por proceso al canal EVENTS_CHANNEL de Redis que reparte cada
+    evento entre las conexiones WebSocket abiertas en este worker.
+    """
+
+    def __init__(self, redis_async):
+        self.redis = redis_async
+        self.connections = set()
+        self.delivered = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, connection: ChatConnection):
+        self.connections.add(connection)
+
+    def unregister(self, connection: ChatConnection):
+        self.connections.discard(connection)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(EVENTS_CHANNEL)
+                logger.info(f"📡 Escuchando eventos en '{EVENTS_CHANNEL}'")
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    try:
+                        evento = json.loads(message["data"])
+                    except (TypeError, ValueError):
+                        continue
+                    await self.broadcast(evento)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error en la suscripción de eventos, reintentando: {e}")
+                await asyncio.sleep(5)
+            finally:
+                try:
+                    await pubsub.reset()
+                except Exception:
+                    pass
+
+    async def broadcast(self, evento: dict):
+        if not self.connections:
+            return
+        enviados = await asyncio.gather(*(c.push_event(evento) for c in list(self.connections)), return_exceptions=True)
+        self.delivered += sum(1 for ok in enviados if ok is True)
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.connections),
+            "events_delivered": self.delivered,
+            "listening": self._task is not None and not self._task.done(),
+        }
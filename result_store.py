@@ -0,0 +1,258 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Número de conjuntos de resultados recientes que se guardan por sesión
+RESULT_SETS_MAX = int(os.getenv("RESULT_SETS_MAX", "3"))
+RESULT_SETS_TTL = int(os.getenv("RESULT_SETS_TTL", "3600"))
+
+# Antigüedad máxima (segundos) con la que se confía en un "abierto ahora" que viene ya calculado
+OPEN_NOW_MAX_AGE = int(os.getenv("OPEN_NOW_MAX_AGE", "900"))
+
+MINUTOS_SEMANA = 7 * 24 * 60
+
+FUENTE_GOOGLE = "google"
+FUENTE_CLAPZY = "clapzy"
+
+NIVELES_PRECIO_GOOGLE = {
+    "PRICE_LEVEL_FREE": 0,
+    "PRICE_LEVEL_INEXPENSIVE": 1,
+    "PRICE_LEVEL_MODERATE": 2,
+    "PRICE_LEVEL_EXPENSIVE": 3,
+    "PRICE_LEVEL_VERY_EXPENSIVE": 4,
+}
+
+
+def _clave_sets(session_id: str) -> str:
+    return f"results:{session_id}"
+
+
+def _clave_raw(session_id: str) -> str:
+    return f"results_raw:{session_id}"
+
+
+def _clave_mostrados(session_id: str) -> str:
+    return f"shown:{session_id}"
+
+
+def _primero(lugar: dict, *claves):
+    for clave in claves:
+        if lugar.get(clave) is not None:
+            return lugar[clave]
+    return None
+
+
+def _nivel_precio(valor) -> Optional[int]:
+    if valor is None:
+        return None
+    if isinstance(valor, str) and valor in NIVELES_PRECIO_GOOGLE:
+        return NIVELES_PRECIO_GOOGLE[valor]
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+def _numero(valor) -> Optional[float]:
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+def _minuto_semana(punto: dict) -> int:
+    # Google numera los días desde el domingo (0)
+    return punto["day"] * 1440 + punto.get("hour", 0) * 60 + punto.get("minute", 0)
+
+
+def _periodos(lugar: dict) -> Optional[List[List[int]]]:
+    """
+    Convierte regularOpeningHours.periods de Google en intervalos [inicio, fin) en minutos
+    de la semana (hora local del lugar). None si el lugar no publica horario.
+    """
+    periods = (lugar.get("regularOpeningHours") or {}).get("periods")
+    if not periods:
+        return None
+    intervalos = []
+    for periodo in periods:
+        if "open" not in periodo:
+            continue
+        if "close" not in periodo:
+            # Un periodo sin cierre significa abierto siempre
+            return [[0, MINUTOS_SEMANA]]
+        inicio, fin = _minuto_semana(periodo["open"]), _minuto_semana(periodo["close"])
+        if fin <= inicio:
+            fin += MINUTOS_SEMANA
+        intervalos.append([inicio, fin])
+    return intervalos or None
+
+
+def abierto_segun_horario(periodos, utc_offset_minutos, ahora: float) -> Optional[bool]:
+    """
+    Calcula si el lugar está abierto en el instante ahora (epoch) a partir de su horario
+    semanal y su desfase UTC. None si falta alguno de los dos.
+    """
+    if periodos is None or utc_offset_minutos is None:
+        return None
+    local = datetime.fromtimestamp(ahora, timezone.utc) + timedelta(minutes=utc_offset_minutos)
+    minuto = ((local.weekday() + 1) % 7) * 1440 + local.hour * 60 + local.minute
+    return any(inicio <= m < fin for inicio, fin in periodos for m in (minuto, minuto + MINUTOS_SEMANA))
+
+
+def compactar(fuente: str, lugar: dict) -> dict:
+    """
+    Extrae de un lugar de Google Places o Clapzy solo los campos por los que se refina:
+    id, nombre, nivel de precio (0-4), rating, nº de reseñas, tipos y si está abierto.
+
+    De Google se guarda el horario semanal (h) y el desfase UTC (z) para calcular "abierto
+    ahora" al refinar; de Clapzy solo hay el valor ya calculado (o), válido mientras sea reciente.
+    """
+    if fuente == FUENTE_GOOGLE:
+        tipos = list(lugar.get("types") or [])
+        if lugar.get("primaryType"):
+            tipos.append(lugar["primaryType"])
+        return {
+            "id": lugar.get("id"),
+            "n": (lugar.get("displayName") or {}).get("text"),
+            "p": _nivel_precio(lugar.get("priceLevel")),
+            "r": _numero(lugar.get("rating")),
+            "c": _numero(lugar.get("userRatingCount")),
+            "t": [str(t).lower() for t in tipos],
+            "h": _periodos(lugar),
+            "z": lugar.get("utcOffsetMinutes"),
+        }
+
+    tipo = _primero(lugar, "establishment_type", "type", "category")
+    if isinstance(tipo, dict):
+        tipo = _primero(tipo, "name", "title")
+    return {
+        "id": str(_primero(lugar, "id", "uuid", "name")),
+        "n": lugar.get("name"),
+        "p": _nivel_precio(_primero(lugar, "price_level", "priceLevel")),
+        "r": _numero(_primero(lugar, "rating", "average_rating")),
+        "c": _numero(_primero(lugar, "reviews_count", "userRatingCount")),
+        "t": [str(tipo).lower()] if tipo else [],
+        "o": _primero(lugar, "open_now", "is_open"),
+    }
+
+
+class ResultStore:
+    """
+    Guarda en Redis los últimos RESULT_SETS_MAX conjuntos de resultados de cada sesión
+    en forma compacta (solo campos filtrables) y los lugares completos indexados por id,
+    para responder refinamientos ("más barato", "no repitas") sin volver a buscar.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def guardar(self, session_id: str, fuente: str, query: str, lugares: List[dict], fetched_at: float = None):
+        """
+        fetched_at es el momento en que se obtuvieron los lugares del upstream (pueden venir
+        de caché); por defecto, ahora.
+        """
+        pares = [(compactar(fuente, lugar), lugar) for lugar in lugares if isinstance(lugar, dict)]
+        pares = [(item, lugar) for item, lugar in pares if item["id"]]
+        if not pares:
+            return
+        items = [item for item, _ in pares]
+        try:
+            pipe = self.redis.pipeline()
+            pipe.lpush(_clave_sets(session_id), json.dumps({
+                "fuente": fuente, "query": query, "fetched_at": fetched_at or time.time(), "items": items
+            }))
+            pipe.ltrim(_clave_sets(session_id), 0, RESULT_SETS_MAX - 1)
+            pipe.hset(_clave_raw(session_id), mapping={
+                f"{fuente}:{item['id']}": json.dumps(lugar) for item, lugar in pares
+            })
+            for clave in (_clave_sets(session_id), _clave_raw(session_id)):
+                pipe.expire(clave, RESULT_SETS_TTL)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"❌ Error guardando conjunto de resultados: {e}")
+
+    def borrar(self, session_id: str):
+        """
+        Elimina los conjuntos guardados y los lugares ya mostrados de la sesión.
+        """
+        self.redis.delete(_clave_sets(session_id), _clave_raw(session_id), _clave_mostrados(session_id))
+
+    def refinar(
+        self,
+        session_id: str,
+        precio_min: Optional[int] = None,
+        precio_max: Optional[int] = None,
+        rating_min: Optional[float] = None,
+        tipo: Optional[str] = None,
+        abierto_ahora: bool = False,
+        excluir: Optional[List[str]] = None,
+        excluir_mostrados: bool = True,
+        limite: int = 10,
+    ) -> dict:
+        """
+        Filtra los conjuntos guardados (del más reciente al más antiguo) y devuelve
+        {"google": [...], "clapzy": [...]} con los lugares completos que cumplen los filtros.
+
+        excluir son nombres (o ids) de lugares ya recomendados. Con excluir_mostrados también
+        se descartan los lugares devueltos por refinamientos anteriores, que quedan registrados.
+        """
+        sets = [json.loads(raw) for raw in self.redis.lrange(_clave_sets(session_id), 0, -1)]
+        mostrados = self.redis.smembers(_clave_mostrados(session_id)) if excluir_mostrados else set()
+        excluidos = {" ".join(str(e).lower().split()) for e in (excluir or [])}
+        tipo = tipo.lower() if tipo else None
+
+        ahora = time.time()
+        elegidos = []
+        vistos = set()
+        for conjunto in sets:
+            reciente = ahora - conjunto.get("fetched_at", 0) <= OPEN_NOW_MAX_AGE
+            for item in conjunto["items"]:
+                clave = f"{conjunto['fuente']}:{item['id']}"
+                if clave in vistos or clave in mostrados:
+                    continue
+                vistos.add(clave)
+                if item["id"].lower() in excluidos or " ".join(str(item["n"]).lower().split()) in excluidos:
+                    continue
+                if precio_min is not None and (item["p"] is None or item["p"] < precio_min):
+                    continue
+                if precio_max is not None and (item["p"] is None or item["p"] > precio_max):
+                    continue
+                if rating_min is not None and (item["r"] is None or item["r"] < rating_min):
+                    continue
+                if tipo and not any(tipo in t for t in item["t"]):
+                    continue
+                if abierto_ahora and self._abierto(item, reciente, ahora) is not True:
+                    continue
+                elegidos.append(clave)
+                if len(elegidos) >= limite:
+                    break
+            if len(elegidos) >= limite:
+                break
+
+        resultado = {FUENTE_GOOGLE: [], FUENTE_CLAPZY: []}
+        if not elegidos:
+            return resultado
+
+        for clave, raw in zip(elegidos, self.redis.hmget(_clave_raw(session_id), elegidos)):
+            if raw:
+                resultado[clave.split(":", 1)[0]].append(json.loads(raw))
+        pipe = self.redis.pipeline()
+        pipe.sadd(_clave_mostrados(session_id), *elegidos)
+        pipe.expire(_clave_mostrados(session_id), RESULT_SETS_TTL)
+        pipe.execute()
+        return resultado
+
+    @staticmethod
+    def _abierto(item: dict, reciente: bool, ahora: float) -> Optional[bool]:
+        """
+        Abierto ahora según el horario guardado; si solo hay el valor ya calculado, se usa
+        únicamente si el conjunto es reciente (si no, se desconoce).
+        """
+        if item.get("h") is not None:
+            return abierto_segun_horario(item["h"], item.get("z"), ahora)
+        return item.get("o") if reciente else None
@@ -0,0 +1,247 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from rate_limiter import PRIORIDAD_BACKGROUND, RateLimited
+from events import EVENTO_INDICE_ACTUALIZADO, publicar_evento
+
+logger = logging.getLogger(__name__)
+
+# Cada cuánto (segundos) se sincroniza el índice con el backend de Clapzy
+SPATIAL_INDEX_REFRESH = int(os.getenv("SPATIAL_INDEX_REFRESH", "1800"))
+# Token invitado con el que se descargan los establecimientos para el índice
+CLAPZY_SYNC_TOKEN = os.getenv("CLAPZY_SYNC_TOKEN") or os.getenv("CLAPZY_WARM_TOKEN")
+SPATIAL_SYNC_PAGE_SIZE = int(os.getenv("SPATIAL_SYNC_PAGE_SIZE", "100"))
+SPATIAL_SYNC_MAX_PAGES = int(os.getenv("SPATIAL_SYNC_MAX_PAGES", "50"))
+SPATIAL_SYNC_MAX_RETRIES = 60
+
+SNAPSHOT_KEY = "spatial:snapshot"
+SNAPSHOT_TS_KEY = "spatial:snapshot:ts"
+SYNC_LOCK_KEY = "spatial:sync:lock"
+
+RADIO_TIERRA_KM = 6371.0088
+KM_POR_GRADO = 111.195
+
+
+def _normalizar(texto: str) -> str:
+    return " ".join(str(texto).strip().lower().split())
+
+
+def extraer_coordenadas(establecimiento: dict):
+    """
+    Devuelve (lat, lon) como float a partir de un establecimiento de Clapzy, o None si no tiene.
+    """
+    fuente = establecimiento.get("location") if isinstance(establecimiento.get("location"), dict) else establecimiento
+    for lat_key, lon_key in (("latitude", "longitude"), ("lat", "lng"), ("lat", "lon")):
+        if fuente.get(lat_key) is not None and fuente.get(lon_key) is not None:
+            try:
+                return float(fuente[lat_key]), float(fuente[lon_key])
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+class SpatialIndex:
+    """
+    Índice espacial inmutable en memoria sobre arrays de numpy.
+
+    Las filas se ordenan por latitud: una búsqueda por radio recorta primero la franja de
+    latitudes con searchsorted, después filtra por longitud y solo entonces calcula la
+    distancia haversine vectorizada sobre los candidatos.
+    """
+
+    def __init__(self, filas: List[dict]):
+        filas = sorted(filas, key=lambda f: f["lat"])
+        self.registros = [f["establecimiento"] for f in filas]
+        self.lat = np.array([f["lat"] for f in filas], dtype=np.float64)
+        self.lon = np.array([f["lon"] for f in filas], dtype=np.float64)
+        self.lat_rad = np.radians(self.lat)
+        self.lon_rad = np.radians(self.lon)
+        tipos = sorted({_normalizar(f["tipo"]) for f in filas})
+        self.codigos_tipo = {tipo: i for i, tipo in enumerate(tipos)}
+        self.tipo = np.array([self.codigos_tipo[_normalizar(f["tipo"])] for f in filas], dtype=np.int32)
+
+    def __len__(self):
+        return len(self.registros)
+
+    def _distancias(self, idx: np.ndarray, lat: float, lon: float) -> np.ndarray:
+        lat0 = np.radians(lat)
+        dlat = self.lat_rad[idx] - lat0
+        dlon = self.lon_rad[idx] - np.radians(lon)
+        a = np.sin(dlat / 2) ** 2 + np.cos(lat0) * np.cos(self.lat_rad[idx]) * np.sin(dlon / 2) ** 2
+        return 2 * RADIO_TIERRA_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+    def _filtrar_tipo(self, idx: np.ndarray, tipo: Optional[str]) -> Optional[np.ndarray]:
+        if tipo is None:
+            return idx
+        codigo = self.codigos_tipo.get(_normalizar(tipo))
+        if codigo is None:
+            return None
+        return idx[self.tipo[idx] == codigo]
+
+    def _resultados(self, idx: np.ndarray, distancias: np.ndarray) -> List[dict]:
+        orden = np.argsort(distancias, kind="stable")
+        return [
+            {**self.registros[i], "distance_km": round(float(d), 3)}
+            for i, d in zip(idx[orden], distancias[orden])
+        ]
+
+    def radio(self, lat: float, lon: float, radio_km: float, tipo: Optional[str] = None) -> List[dict]:
+        """
+        Establecimientos a menos de radio_km de (lat, lon), ordenados por distancia.
+        """
+        delta_lat = radio_km / KM_POR_GRADO
+        inicio = np.searchsorted(self.lat, lat - delta_lat, side="left")
+        fin = np.searchsorted(self.lat, lat + delta_lat, side="right")
+        idx = np.arange(inicio, fin)
+
+        cos_lat = np.cos(np.radians(lat))
+        if cos_lat > 1e-6:
+            delta_lon = radio_km / (KM_POR_GRADO * cos_lat)
+            if delta_lon < 180:
+                dif = np.abs((self.lon[idx] - lon + 180) % 360 - 180)
+                idx = idx[dif <= delta_lon]
+
+        idx = self._filtrar_tipo(idx, tipo)
+        if idx is None or len(idx) == 0:
+            return []
+        distancias = self._distancias(idx, lat, lon)
+        dentro = distancias <= radio_km
+        return self._resultados(idx[dentro], distancias[dentro])
+
+    def cercanos(self, lat: float, lon: float, k: int, tipo: Optional[str] = None) -> List[dict]:
+        """
+        Los k establecimientos más cercanos a (lat, lon), ordenados por distancia.
+        """
+        idx = self._filtrar_tipo(np.arange(len(self)), tipo)
+        if idx is None or len(idx) == 0 or k <= 0:
+            return []
+        distancias = self._distancias(idx, lat, lon)
+        if k < len(idx):
+            top = np.argpartition(distancias, k - 1)[:k]
+            idx, distancias = idx[top], distancias[top]
+        return self._resultados(idx, distancias)
+
+
+class SpatialIndexSync:
+    """
+    Mantiene un SpatialIndex sincronizado con el backend de Clapzy en segundo plano.
+
+    Una sola réplica (lock en Redis) descarga los establecimientos de todas las combinaciones
+    ciudad × tipo y publica una instantánea en Redis; el resto de procesos reconstruyen su
+    índice local a partir de esa instantánea sin llamar al backend.
+    """
+
+    def __init__(self, redis, ciudades: List[str], tipos: List[str], consultar_clapzy: Callable):
+        self.redis = redis
+        self.ciudades = ciudades
+        self.tipos = tipos
+        self.consultar_clapzy = consultar_clapzy
+        self.index: Optional[SpatialIndex] = None
+        self._snapshot_ts = 0.0
+        self._stop = threading.Event()
+
+    @property
+    def actualizado_en(self) -> float:
+        """
+        Momento (epoch) en que se descargaron los datos del índice cargado.
+        """
+        return self._snapshot_ts
+
+    def start(self):
+        if not CLAPZY_SYNC_TOKEN and self.redis is None:
+            logger.warning("⚠️ Sin CLAPZY_SYNC_TOKEN ni Redis, no se construye el índice espacial")
+            return
+        threading.Thread(target=self._run, name="spatial-index-sync", daemon=True).start()
+        logger.info(f"🗺️ Sincronización del índice espacial iniciada (cada {SPATIAL_INDEX_REFRESH}s)")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.sincronizar()
+            except Exception as e:
+                logger.error(f"❌ Error sincronizando índice espacial: {e}")
+            # Se revisa la instantánea con más frecuencia que el refresco completo
+            if self._stop.wait(min(SPATIAL_INDEX_REFRESH, 60)):
+                return
+
+    def sincronizar(self):
+        if self.redis is None:
+            if time.time() - self._snapshot_ts >= SPATIAL_INDEX_REFRESH:
+                self._cargar(self._descargar(), time.time())
+            return
+
+        ts = float(self.redis.get(SNAPSHOT_TS_KEY) or 0)
+        if time.time() - ts >= SPATIAL_INDEX_REFRESH and CLAPZY_SYNC_TOKEN:
+            if self.redis.set(SYNC_LOCK_KEY, "1", nx=True, ex=SPATIAL_INDEX_REFRESH):
+                try:
+                    filas = self._descargar()
+                    ts = time.time()
+                    self.redis.set(SNAPSHOT_KEY, json.dumps(filas))
+                    self.redis.set(SNAPSHOT_TS_KEY, str(ts))
+                    self._cargar(filas, ts)
+                    publicar_evento(self.redis, EVENTO_INDICE_ACTUALIZADO, {"rows": len(filas)})
+                    return
+                finally:
+                    self.redis.delete(SYNC_LOCK_KEY)
+
+        if ts > self._snapshot_ts:
+            raw = self.redis.get(SNAPSHOT_KEY)
+            if raw:
+                self._cargar(json.loads(raw), ts)
+
+    def _cargar(self, filas: List[dict], ts: float):
+        inicio = time.perf_counter()
+        self.index = SpatialIndex(filas)
+        self._snapshot_ts = ts
+        logger.info(f"🗺️ Índice espacial cargado: {len(self.index)} filas en {(time.perf_counter() - inicio) * 1000:.1f}ms")
+
+    def _descargar(self) -> List[dict]:
+        filas = []
+        vistos = set()
+        for ciudad in self.ciudades:
+            for tipo in self.tipos:
+                for page in range(1, SPATIAL_SYNC_MAX_PAGES + 1):
+                    # Modo invitado: token y session_id coinciden
+                    lote = self._consultar_pagina(ciudad, tipo, page)
+                    if isinstance(lote, str):
+                        raise RuntimeError(f"{ciudad}/{tipo}: {lote}")
+                    for establecimiento in lote:
+                        if not isinstance(establecimiento, dict):
+                            continue
+                        coordenadas = extraer_coordenadas(establecimiento)
+                        clave = (establecimiento.get("id", establecimiento.get("name")), _normalizar(tipo))
+                        if coordenadas is None or clave in vistos:
+                            continue
+                        vistos.add(clave)
+                        filas.append({
+                            "lat": coordenadas[0],
+                            "lon": coordenadas[1],
+                            "tipo": tipo,
+                            "establecimiento": establecimiento,
+                        })
+                    if len(lote) < SPATIAL_SYNC_PAGE_SIZE:
+                        break
+        logger.info(f"🗺️ Descargados {len(filas)} establecimientos para el índice espacial")
+        return filas
+
+    def _consultar_pagina(self, ciudad: str, tipo: str, page: int):
+        # La sincronización no tiene prisa: si no hay cupo espera en vez de competir con los usuarios
+        for _ in range(SPATIAL_SYNC_MAX_RETRIES):
+            try:
+                return self.consultar_clapzy(
+                    ciudad, tipo, CLAPZY_SYNC_TOKEN, CLAPZY_SYNC_TOKEN, page, SPATIAL_SYNC_PAGE_SIZE,
+                    prioridad=PRIORIDAD_BACKGROUND,
+                )
+            except RateLimited:
+                if self._stop.wait(1):
+                    break
+        raise RuntimeError(f"{ciudad}/{tipo}: sin cupo de Clapzy para sincronizar")